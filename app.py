@@ -1,29 +1,727 @@
 import os
 import sys
 import telebot
-from flask import Flask, request
+from flask import Flask, Response, request
 import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+import requests
 from groq import Groq
+import codecs
+import csv
+import hashlib
+import hmac
+import io
+import itertools
 import json
+import queue
+import re
+import tempfile
+import time
+import unicodedata
+import zipfile
+import threading
+import atexit
 import traceback
-from datetime import datetime, timedelta
+from collections import OrderedDict
+from contextlib import contextmanager
+from xml.sax.saxutils import escape as xml_escape
+from datetime import date, datetime, timedelta
 
 # --- CONFIGURAÇÕES ---
 TOKEN = os.environ.get('TELEGRAM_TOKEN')
 DB_URI = os.environ.get('DB_URI')
 GROQ_API_KEY = os.environ.get('GROQ_API_KEY')
 
-client = Groq(api_key=GROQ_API_KEY)
+# Pool de conexões com o Postgres (um pool por worker do gunicorn)
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', 5))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+DB_POOL_CHECK_IDLE = float(os.environ.get('DB_POOL_CHECK_IDLE', 30))
+DB_POOL_MAX_IDLE = float(os.environ.get('DB_POOL_MAX_IDLE', 300))
+
+# Cache das respostas da IA (AI_CACHE_SHARED=1 compartilha os acertos entre workers via Postgres)
+AI_CACHE_SIZE = int(os.environ.get('AI_CACHE_SIZE', 2048))
+AI_CACHE_TTL = float(os.environ.get('AI_CACHE_TTL', 6 * 3600))
+AI_CACHE_SHARED = os.environ.get('AI_CACHE_SHARED', '0').lower() in ('1', 'true', 'yes')
+
+# Fila de processamento do webhook (o Telegram recebe 200 na hora)
+WEBHOOK_ASYNC = os.environ.get('WEBHOOK_ASYNC', '1').lower() in ('1', 'true', 'yes')
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', 4))
+WEBHOOK_QUEUE_SIZE = int(os.environ.get('WEBHOOK_QUEUE_SIZE', 100))
+WEBHOOK_ENQUEUE_TIMEOUT = float(os.environ.get('WEBHOOK_ENQUEUE_TIMEOUT', 2))
+WEBHOOK_DEDUP_SIZE = int(os.environ.get('WEBHOOK_DEDUP_SIZE', 10000))
+WEBHOOK_DEDUP_TTL = float(os.environ.get('WEBHOOK_DEDUP_TTL', 48 * 3600))  # o Telegram reenvia por até ~24h
+WEBHOOK_CLAIM_TIMEOUT = float(os.environ.get('WEBHOOK_CLAIM_TIMEOUT', 1))  # espera máxima por conexão no registro do update_id
+
+# Cache dos nomes de bancos e categorias de cada usuário
+RESOLVER_CACHE_SIZE = int(os.environ.get('RESOLVER_CACHE_SIZE', 2048))
+RESOLVER_CACHE_TTL = float(os.environ.get('RESOLVER_CACHE_TTL', 300))
+
+# Importação de extratos (CSV/OFX) enviados como documento no chat
+IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', 1000))
+IMPORT_MAX_CONCURRENT = int(os.environ.get('IMPORT_MAX_CONCURRENT', 1))
+IMPORT_PROGRESS_EVERY = float(os.environ.get('IMPORT_PROGRESS_EVERY', 5))
+IMPORT_SIGN_SAMPLE = int(os.environ.get('IMPORT_SIGN_SAMPLE', 50))
+IMPORT_MAX_FILE_SIZE = 20 * 1024 * 1024  # limite do getFile da API do Telegram
+
+# Ações incompletas (ex.: gasto esperando o banco). 'postgres' compartilha entre os workers
+PENDING_BACKEND = os.environ.get('PENDING_BACKEND', 'postgres').lower()
+PENDING_TTL = float(os.environ.get('PENDING_TTL', 600))
+PENDING_MAX_SIZE = int(os.environ.get('PENDING_MAX_SIZE', 10000))
+
+# Métricas: updates mais lentos que isso (em segundos) são logados com o detalhamento. 0 desliga
+SLOW_UPDATE_SECONDS = float(os.environ.get('SLOW_UPDATE_SECONDS', 0))
+
+# Prazo por mensagem e disjuntor da IA: com a Groq fora, o bot não trava 15 s por mensagem
+AI_TIMEOUT = float(os.environ.get('AI_TIMEOUT', 15))
+AI_MAX_RETRIES = int(os.environ.get('AI_MAX_RETRIES', 0))
+UPDATE_DEADLINE_SECONDS = float(os.environ.get('UPDATE_DEADLINE_SECONDS', 20))
+AI_DEADLINE_RESERVE = float(os.environ.get('AI_DEADLINE_RESERVE', 3))
+AI_MIN_TIMEOUT = float(os.environ.get('AI_MIN_TIMEOUT', 1))
+AI_BREAKER_FAILURES = int(os.environ.get('AI_BREAKER_FAILURES', 3))
+AI_BREAKER_RESET = float(os.environ.get('AI_BREAKER_RESET', 30))
+AI_DEFERRED_POLL = float(os.environ.get('AI_DEFERRED_POLL', 15))
+AI_DEFERRED_MAX_AGE = float(os.environ.get('AI_DEFERRED_MAX_AGE', 6 * 3600))
+
+# Lembretes de contas (rodados pelo cron via /jobs/bill_reminders ou `python app.py send_reminders`)
+REMINDER_DAYS_AHEAD = int(os.environ.get('REMINDER_DAYS_AHEAD', 3))
+REMINDER_JOB_TOKEN = os.environ.get('REMINDER_JOB_TOKEN')
+REMINDER_GLOBAL_RATE = float(os.environ.get('REMINDER_GLOBAL_RATE', 25))  # a API aceita ~30 msg/s por bot
+REMINDER_CHAT_INTERVAL = float(os.environ.get('REMINDER_CHAT_INTERVAL', 1))  # ~1 msg/s por chat
+REMINDER_MAX_RETRIES = int(os.environ.get('REMINDER_MAX_RETRIES', 3))
+
+# Exportação de extratos (CSV/XLSX)
+EXPORT_FETCH_SIZE = int(os.environ.get('EXPORT_FETCH_SIZE', 2000))
+EXPORT_MAX_CONCURRENT = int(os.environ.get('EXPORT_MAX_CONCURRENT', 2))
+EXPORT_SECRET = os.environ.get('EXPORT_SECRET') or TOKEN
+EXPORT_BASE_URL = (os.environ.get('EXPORT_BASE_URL') or '').rstrip('/')
+EXPORT_LINK_TTL = float(os.environ.get('EXPORT_LINK_TTL', 3600))
+# O envio pelo Telegram monta o multipart em memória, então arquivos maiores viram link
+EXPORT_DOCUMENT_MAX = int(os.environ.get('EXPORT_DOCUMENT_MAX', 10 * 1024 * 1024))
+
+# Histórico de saldos: um snapshot por conta a cada N lançamentos no ledger
+LEDGER_SNAPSHOT_EVERY = int(os.environ.get('LEDGER_SNAPSHOT_EVERY', 200))
+
+client = Groq(api_key=GROQ_API_KEY, max_retries=AI_MAX_RETRIES)
 bot = telebot.TeleBot(TOKEN, threaded=False)
 app = Flask(__name__)
 
 # --- MEMÓRIA TEMPORÁRIA PARA AÇÕES INCOMPLETAS ---
-pending_user_actions = {}
+# Todas as operações recebem o cursor da mensagem em andamento, para o backend em
+# Postgres não precisar de uma segunda conexão do pool.
+class PendingActionStore:
+    def __init__(self, backend, ttl, maxsize):
+        self.backend = backend
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._sets = 0
+        self._stats = {'sets': 0, 'hits': 0, 'misses': 0, 'expired': 0, 'evicted': 0}
+
+    def _count(self, stat, n=1):
+        with self._lock:
+            self._stats[stat] += n
+
+    def get(self, cur, user_id):
+        if self.backend == 'postgres':
+            cur.execute("SELECT data FROM pending_actions WHERE user_id = %s AND expires_at > now()", (user_id,))
+            row = cur.fetchone()
+            data = row[0] if row else None
+        else:
+            with self._lock:
+                item = self._items.get(user_id)
+                if item and item[1] <= time.monotonic():
+                    del self._items[user_id]
+                    self._stats['expired'] += 1
+                    item = None
+                data = dict(item[0]) if item else None
+        self._count('hits' if data is not None else 'misses')
+        return data
+
+    def set(self, cur, user_id, data):
+        self._count('sets')
+        if self.backend != 'postgres':
+            with self._lock:
+                self._items[user_id] = (dict(data), time.monotonic() + self.ttl)
+                self._items.move_to_end(user_id)
+                while len(self._items) > self.maxsize:
+                    self._items.popitem(last=False)
+                    self._stats['evicted'] += 1
+            return
+        cur.execute("""
+            INSERT INTO pending_actions (user_id, data, expires_at) VALUES (%s, %s, now() + %s * INTERVAL '1 second')
+            ON CONFLICT (user_id) DO UPDATE SET data = EXCLUDED.data, expires_at = EXCLUDED.expires_at
+        """, (user_id, psycopg2.extras.Json(data), self.ttl))
+        with self._lock:
+            self._sets += 1
+            limpar = self._sets % 100 == 0
+        if limpar:
+            cur.execute("DELETE FROM pending_actions WHERE expires_at <= now()")
+            self._count('expired', cur.rowcount)
+            cur.execute("""
+                DELETE FROM pending_actions WHERE user_id IN (
+                    SELECT user_id FROM pending_actions ORDER BY expires_at DESC OFFSET %s
+                )
+            """, (self.maxsize,))
+            self._count('evicted', cur.rowcount)
+        # A ação pendente precisa sobreviver ao fim desta mensagem
+        cur.connection.commit()
+
+    def pop(self, cur, user_id):
+        if self.backend != 'postgres':
+            with self._lock:
+                item = self._items.pop(user_id, None)
+            if item and item[1] <= time.monotonic():
+                self._count('expired')
+                return None
+            return dict(item[0]) if item else None
+        # DELETE ... RETURNING: só um worker consegue consumir a mesma ação
+        cur.execute("DELETE FROM pending_actions WHERE user_id = %s RETURNING data, expires_at > now()", (user_id,))
+        row = cur.fetchone()
+        cur.connection.commit()
+        return row[0] if row and row[1] else None
+
+    def stats(self, cur=None):
+        with self._lock:
+            s = dict(self._stats)
+            s['size'] = len(self._items)
+        if self.backend == 'postgres' and cur is not None:
+            cur.execute("SELECT count(*), count(*) FILTER (WHERE expires_at <= now()) FROM pending_actions")
+            s['size'], s['expired_waiting_cleanup'] = cur.fetchone()
+        s['backend'] = self.backend
+        s['max_size'] = self.maxsize
+        s['ttl'] = self.ttl
+        return s
+
+pending_user_actions = PendingActionStore(PENDING_BACKEND, PENDING_TTL, PENDING_MAX_SIZE)
+
+# --- MÉTRICAS E TEMPOS POR ETAPA ---
+# Histogramas e contadores no formato de texto do Prometheus, servidos em /metrics.
+# Os valores são por processo: cada worker do gunicorn expõe os seus.
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 15, 30)
+
+METRICS_HELP = {
+    'zap_update_seconds': ('histogram', 'Tempo total de processamento de uma mensagem, por ação.'),
+    'zap_stage_seconds': ('histogram', 'Tempo gasto em cada etapa de uma mensagem, por ação.'),
+    'zap_sql_query_seconds': ('histogram', 'Duração de cada consulta SQL feita ao tratar uma mensagem, por ação.'),
+    'zap_updates_total': ('counter', 'Mensagens processadas, por ação.'),
+    'zap_update_errors_total': ('counter', 'Mensagens que terminaram em erro interno.'),
+    'zap_ai_failures_total': ('counter', 'Chamadas à IA que falharam ou estouraram o timeout.'),
+    'zap_ai_fallback_chat_total': ('counter', "Mensagens tratadas como 'chat' porque a IA não respondeu."),
+    'zap_ai_unavailable_total': ('counter', 'Chamadas à IA não feitas ou perdidas, por motivo (circuit_open, deadline, error).'),
+    'zap_ai_deferred_total': ('counter', 'Mensagens guardadas para reprocessar quando a IA voltar.'),
+    'zap_reminders_sent_total': ('counter', 'Resumos de contas a vencer enviados pelo job de lembretes.'),
+    'zap_reminders_failed_total': ('counter', 'Resumos de contas a vencer que não puderam ser enviados.'),
+    'zap_telegram_throttled_total': ('counter', 'Respostas 429 da API do Telegram durante envios em massa.'),
+}
+
+class Metrics:
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            h = self._histograms.get(key)
+            if h is None:
+                h = self._histograms[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, limite in enumerate(self.buckets):
+                if value <= limite:
+                    h[i] += 1
+            h[-2] += value
+            h[-1] += 1
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
 
-def get_db():
-    return psycopg2.connect(DB_URI, connect_timeout=60)
+    @staticmethod
+    def _labels(labels, extra=()):
+        itens = list(labels) + list(extra)
+        if not itens:
+            return ''
+        return '{' + ','.join(f'{k}="{str(v)}"' for k, v in itens) + '}'
 
-def process_with_ai(text):
+    def render(self, gauges=None):
+        with self._lock:
+            histogramas = {k: list(v) for k, v in self._histograms.items()}
+            contadores = dict(self._counters)
+        linhas = []
+        vistos = set()
+
+        def cabecalho(name, tipo=None, ajuda=None):
+            if name not in vistos:
+                vistos.add(name)
+                tipo_padrao, ajuda_padrao = METRICS_HELP.get(name, (tipo, ''))
+                linhas.append(f"# HELP {name} {ajuda or ajuda_padrao}")
+                linhas.append(f"# TYPE {name} {tipo or tipo_padrao}")
+
+        for (name, labels), h in sorted(histogramas.items()):
+            cabecalho(name, 'histogram')
+            for limite, qtd in zip(self.buckets, h):
+                linhas.append(f"{name}_bucket{self._labels(labels, [('le', limite)])} {qtd}")
+            linhas.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {h[-1]}")
+            linhas.append(f"{name}_sum{self._labels(labels)} {h[-2]:.6f}")
+            linhas.append(f"{name}_count{self._labels(labels)} {h[-1]}")
+        for (name, labels), valor in sorted(contadores.items()):
+            cabecalho(name, 'counter')
+            linhas.append(f"{name}{self._labels(labels)} {valor}")
+        for name, valor in sorted((gauges or {}).items()):
+            cabecalho(name, 'gauge', 'Estatística interna exposta por /stats.')
+            linhas.append(f"{name} {valor}")
+        return "\n".join(linhas) + "\n"
+
+metrics = Metrics()
+_trace_local = threading.local()
+
+def start_trace():
+    _trace_local.atual = {'inicio': time.perf_counter(), 'ativa': None, 'stages': {}, 'queries': []}
+
+@contextmanager
+def stage(nome):
+    # Só a etapa mais externa conta, então as etapas nunca se sobrepõem no detalhamento
+    trace = getattr(_trace_local, 'atual', None)
+    if trace is None or trace['ativa'] is not None:
+        yield
+        return
+    trace['ativa'] = nome
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        duracao = time.perf_counter() - inicio
+        trace['ativa'] = None
+        trace['stages'][nome] = trace['stages'].get(nome, 0.0) + duracao
+        if nome == 'sql':
+            trace['queries'].append(duracao)
+
+def finish_trace(action):
+    trace = getattr(_trace_local, 'atual', None)
+    _trace_local.atual = None
+    if trace is None:
+        return
+    total = time.perf_counter() - trace['inicio']
+    # A ação vem da IA: qualquer valor fora da lista vira 'other' para não explodir os rótulos
+    action = action if action in ACOES_CONHECIDAS else ('unknown' if action is None else 'other')
+    metrics.observe('zap_update_seconds', total, action=action)
+    metrics.inc('zap_updates_total', action=action)
+    stages = dict(trace['stages'])
+    stages['other'] = max(0.0, total - sum(stages.values()))
+    for nome, duracao in stages.items():
+        metrics.observe('zap_stage_seconds', duracao, stage=nome, action=action)
+    for duracao in trace['queries']:
+        metrics.observe('zap_sql_query_seconds', duracao, action=action)
+    if SLOW_UPDATE_SECONDS and total >= SLOW_UPDATE_SECONDS:
+        detalhes = {nome: round(d * 1000, 1) for nome, d in sorted(stages.items(), key=lambda x: -x[1])}
+        print(f"Update lento ({action}): {total * 1000:.0f} ms | etapas (ms): {json.dumps(detalhes)} | "
+              f"consultas: {len(trace['queries'])}", flush=True)
+
+class TimedCursor(psycopg2.extensions.cursor):
+    def execute(self, query, vars=None):
+        with stage('sql'):
+            return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        with stage('sql'):
+            return super().executemany(query, vars_list)
+
+def _instrument_bot_method(nome):
+    original = getattr(bot, nome)
+
+    def wrapper(*args, **kwargs):
+        with stage('telegram_send'):
+            return original(*args, **kwargs)
+    wrapper.__name__ = original.__name__
+    setattr(bot, nome, wrapper)
+
+for _metodo in ('reply_to', 'send_message', 'edit_message_text', 'send_document'):
+    _instrument_bot_method(_metodo)
+
+# --- POOL DE CONEXÕES ---
+class PoolTimeout(Exception):
+    pass
+
+class ConnectionPool:
+    """Pool de conexões thread-safe com health check no empréstimo.
+
+    Cada processo (worker do gunicorn) tem o seu próprio pool: se o processo
+    for clonado por fork, as conexões herdadas são descartadas sem serem usadas.
+    """
+
+    def __init__(self, dsn, minconn=1, maxconn=5, timeout=30, check_idle=30, max_idle=300):
+        self.dsn = dsn
+        self.minconn = max(0, minconn)
+        self.maxconn = max(1, maxconn, self.minconn)
+        self.timeout = timeout
+        self.check_idle = check_idle
+        self.max_idle = max_idle
+        self.pid = os.getpid()
+        self._cond = threading.Condition()
+        self._idle = []
+        self._size = 0
+        self._stats = {
+            'checkouts': 0, 'waits': 0, 'timeouts': 0, 'connects': 0,
+            'reconnects': 0, 'discarded': 0, 'acquire_time_total': 0.0, 'acquire_time_max': 0.0,
+        }
+
+    def _connect(self):
+        conn = psycopg2.connect(
+            self.dsn, connect_timeout=60, cursor_factory=TimedCursor,
+            keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=3
+        )
+        with self._cond:
+            self._stats['connects'] += 1
+        return conn
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def warmup(self):
+        while True:
+            with self._cond:
+                if self._size >= self.minconn:
+                    return
+                self._size += 1
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                raise
+            with self._cond:
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+
+    def _validate(self, conn, last_used):
+        if conn is None:
+            return self._connect()
+        if conn.closed:
+            with self._cond:
+                self._stats['reconnects'] += 1
+            return self._connect()
+        if time.monotonic() - last_used >= self.check_idle:
+            # O servidor pode ter derrubado o socket ocioso: testa antes de entregar
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT 1")
+                conn.rollback()
+            except psycopg2.Error:
+                self._close(conn)
+                with self._cond:
+                    self._stats['reconnects'] += 1
+                return self._connect()
+        return conn
+
+    def getconn(self, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        inicio = time.monotonic()
+        prazo = inicio + timeout
+        conn, last_used = None, None
+        with self._cond:
+            esperou = False
+            while True:
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._size < self.maxconn:
+                    self._size += 1
+                    break
+                if not esperou:
+                    esperou = True
+                    self._stats['waits'] += 1
+                restante = prazo - time.monotonic()
+                if restante <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolTimeout(f"Nenhuma conexão livre após {timeout}s")
+                self._cond.wait(restante)
+        try:
+            conn = self._validate(conn, last_used)
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        decorrido = time.monotonic() - inicio
+        with self._cond:
+            self._stats['checkouts'] += 1
+            self._stats['acquire_time_total'] += decorrido
+            self._stats['acquire_time_max'] = max(self._stats['acquire_time_max'], decorrido)
+        return conn
+
+    def putconn(self, conn, discard=False):
+        if not discard and not conn.closed:
+            # Nunca devolve ao pool uma transação aberta ou abortada
+            if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    discard = True
+        agora = time.monotonic()
+        descartar = []
+        with self._cond:
+            if discard or conn.closed:
+                self._size -= 1
+                self._stats['discarded'] += 1
+                descartar.append(conn)
+            else:
+                self._idle.append((conn, agora))
+            # Fecha conexões ociosas há muito tempo, mantendo o mínimo configurado
+            while self._size > self.minconn and self._idle and agora - self._idle[0][1] > self.max_idle:
+                velha, _ = self._idle.pop(0)
+                self._size -= 1
+                descartar.append(velha)
+            self._cond.notify()
+        for c in descartar:
+            self._close(c)
+
+    def closeall(self):
+        with self._cond:
+            ociosas, self._idle = self._idle, []
+            self._size -= len(ociosas)
+        for conn, _ in ociosas:
+            self._close(conn)
+
+    def stats(self):
+        with self._cond:
+            s = dict(self._stats)
+            s['size'] = self._size
+            s['idle'] = len(self._idle)
+            s['in_use'] = self._size - len(self._idle)
+            s['min'] = self.minconn
+            s['max'] = self.maxconn
+        s['acquire_ms_avg'] = round(s['acquire_time_total'] * 1000 / s['checkouts'], 3) if s['checkouts'] else 0.0
+        s['acquire_ms_max'] = round(s.pop('acquire_time_max') * 1000, 3)
+        s.pop('acquire_time_total')
+        return s
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+
+def get_pool():
+    global _db_pool
+    pool = _db_pool
+    if pool is None or pool.pid != os.getpid():
+        with _db_pool_lock:
+            if _db_pool is None or _db_pool.pid != os.getpid():
+                # Depois de um fork, não reaproveita sockets do processo pai
+                _db_pool = ConnectionPool(DB_URI, DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT,
+                                          DB_POOL_CHECK_IDLE, DB_POOL_MAX_IDLE)
+                try:
+                    _db_pool.warmup()
+                except Exception as e:
+                    print(f"Erro ao aquecer o pool do banco: {e}", flush=True)
+            pool = _db_pool
+    return pool
+
+def get_db(timeout=None):
+    pool = get_pool()
+    if not _schema_ready:
+        ensure_schema(pool)
+    return pool.getconn(timeout)
+
+def release_db(conn, discard=False):
+    get_pool().putconn(conn, discard=discard)
+
+# --- MIGRAÇÕES DO BANCO ---
+# Cada migração roda uma única vez (registrada em schema_migrations). O advisory lock
+# garante que só um worker do gunicorn aplica as migrações quando vários sobem juntos.
+MIGRATIONS_LOCK_ID = 7317001
+
+MIGRATIONS = [
+    ('0001_category_month_spend', """
+        CREATE TABLE IF NOT EXISTS category_month_spend (
+            user_id INTEGER NOT NULL,
+            category TEXT NOT NULL,
+            month DATE NOT NULL,
+            total NUMERIC(14, 2) NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, month, category)
+        );
+
+        CREATE OR REPLACE FUNCTION category_month_spend_apply() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') AND COALESCE(OLD.type, 'expense') = 'expense' THEN
+                UPDATE category_month_spend SET total = total - OLD.amount
+                WHERE user_id = OLD.user_id
+                  AND month = date_trunc('month', OLD.date)::date
+                  AND category = upper(COALESCE(OLD.category, ''));
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') AND COALESCE(NEW.type, 'expense') = 'expense' THEN
+                INSERT INTO category_month_spend (user_id, category, month, total)
+                VALUES (NEW.user_id, upper(COALESCE(NEW.category, '')), date_trunc('month', NEW.date)::date, NEW.amount)
+                ON CONFLICT (user_id, month, category) DO UPDATE SET total = category_month_spend.total + EXCLUDED.total;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        -- Bloqueia escritas enquanto o backfill roda para o trigger não perder nem duplicar linhas
+        LOCK TABLE transactions IN SHARE ROW EXCLUSIVE MODE;
+
+        DROP TRIGGER IF EXISTS transactions_category_month_spend ON transactions;
+        CREATE TRIGGER transactions_category_month_spend
+            AFTER INSERT OR DELETE OR UPDATE OF user_id, amount, category, date, type ON transactions
+            FOR EACH ROW EXECUTE FUNCTION category_month_spend_apply();
+
+        DELETE FROM category_month_spend;
+        INSERT INTO category_month_spend (user_id, category, month, total)
+        SELECT user_id, upper(COALESCE(category, '')), date_trunc('month', date)::date, SUM(amount)
+        FROM transactions
+        WHERE COALESCE(type, 'expense') = 'expense'
+        GROUP BY 1, 2, 3;
+    """),
+    ('0002_transactions_user_date_idx', """
+        CREATE INDEX IF NOT EXISTS transactions_user_date_idx ON transactions (user_id, date);
+    """),
+    ('0003_bills_user_status_due_idx', """
+        CREATE INDEX IF NOT EXISTS unpaid_bills_user_paid_due_idx ON unpaid_bills (user_id, is_paid, due_date);
+        CREATE INDEX IF NOT EXISTS scheduled_expenses_user_active_due_idx ON scheduled_expenses (user_id, is_active, due_date);
+    """),
+    ('0004_transactions_user_category_idx', """
+        CREATE INDEX IF NOT EXISTS transactions_user_upper_category_idx ON transactions (user_id, upper(category));
+    """),
+    ('0005_pending_actions', """
+        CREATE UNLOGGED TABLE IF NOT EXISTS pending_actions (
+            user_id INTEGER PRIMARY KEY,
+            data JSONB NOT NULL,
+            expires_at TIMESTAMPTZ NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS pending_actions_expires_idx ON pending_actions (expires_at);
+    """),
+    ('0006_deferred_messages', """
+        CREATE TABLE IF NOT EXISTS deferred_messages (
+            id SERIAL PRIMARY KEY,
+            chat_id BIGINT NOT NULL,
+            message_json TEXT NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+    """),
+    ('0007_bill_reminders', """
+        CREATE TABLE IF NOT EXISTS bill_reminders (
+            source TEXT NOT NULL,
+            bill_id INTEGER NOT NULL,
+            due_date DATE NOT NULL,
+            chat_id BIGINT NOT NULL,
+            sent_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            PRIMARY KEY (source, bill_id, due_date)
+        );
+        -- O job busca por vencimento de todos os usuários de uma vez
+        CREATE INDEX IF NOT EXISTS unpaid_bills_open_due_idx ON unpaid_bills (due_date) WHERE is_paid = false;
+        CREATE INDEX IF NOT EXISTS scheduled_expenses_active_due_idx ON scheduled_expenses (due_date) WHERE is_active = true;
+    """),
+    ('0008_account_ledger', """
+        ALTER TABLE accounts ADD COLUMN IF NOT EXISTS ledger_entries INTEGER NOT NULL DEFAULT 0;
+
+        CREATE TABLE IF NOT EXISTS account_ledger (
+            id BIGSERIAL PRIMARY KEY,
+            account_id INTEGER NOT NULL REFERENCES accounts (id) ON DELETE CASCADE,
+            user_id INTEGER NOT NULL,
+            transaction_id INTEGER,
+            amount NUMERIC(14, 2) NOT NULL,
+            kind TEXT NOT NULL,
+            created_at TIMESTAMP NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS account_ledger_account_time_idx ON account_ledger (account_id, created_at, id);
+        CREATE INDEX IF NOT EXISTS account_ledger_transaction_idx ON account_ledger (transaction_id) WHERE transaction_id IS NOT NULL;
+
+        CREATE TABLE IF NOT EXISTS account_snapshots (
+            account_id INTEGER NOT NULL REFERENCES accounts (id) ON DELETE CASCADE,
+            as_of TIMESTAMP NOT NULL,
+            ledger_id BIGINT NOT NULL,
+            balance NUMERIC(14, 2) NOT NULL,
+            PRIMARY KEY (account_id, as_of, ledger_id)
+        );
+
+        -- O ledger só recebe inserções; apagar linhas só acontece junto com a conta (cascade)
+        CREATE OR REPLACE FUNCTION account_ledger_append_only() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' AND pg_trigger_depth() > 1 THEN
+                RETURN OLD;
+            END IF;
+            RAISE EXCEPTION 'account_ledger aceita apenas inserções; lance um estorno';
+        END;
+        $$ LANGUAGE plpgsql;
+
+        DROP TRIGGER IF EXISTS account_ledger_append_only ON account_ledger;
+        CREATE TRIGGER account_ledger_append_only
+            BEFORE UPDATE OR DELETE ON account_ledger
+            FOR EACH ROW EXECUTE FUNCTION account_ledger_append_only();
+
+        -- Backfill: o saldo atual de cada conta vira o lançamento de abertura do histórico
+        LOCK TABLE accounts IN SHARE ROW EXCLUSIVE MODE;
+        WITH abertura AS (
+            INSERT INTO account_ledger (account_id, user_id, amount, kind, created_at)
+            SELECT id, user_id, balance, 'opening', CURRENT_TIMESTAMP AT TIME ZONE 'UTC' - INTERVAL '3 hours'
+            FROM accounts WHERE balance <> 0
+            RETURNING id, account_id, amount, created_at
+        )
+        INSERT INTO account_snapshots (account_id, as_of, ledger_id, balance)
+        SELECT account_id, created_at, id, amount FROM abertura;
+        UPDATE accounts SET ledger_entries = 1 WHERE balance <> 0;
+    """),
+    ('0009_processed_updates', """
+        CREATE UNLOGGED TABLE IF NOT EXISTS processed_updates (
+            update_id BIGINT PRIMARY KEY,
+            received_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        CREATE INDEX IF NOT EXISTS processed_updates_received_idx ON processed_updates (received_at);
+    """),
+    ('0010_ai_cache', """
+        CREATE UNLOGGED TABLE IF NOT EXISTS ai_cache (
+            key TEXT PRIMARY KEY, result JSONB NOT NULL, expires_at TIMESTAMPTZ NOT NULL
+        );
+    """),
+]
+
+_schema_ready = False
+_schema_lock = threading.Lock()
+
+def run_migrations(conn):
+    cur = conn.cursor()
+    cur.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATIONS_LOCK_ID,))
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            name TEXT PRIMARY KEY, applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+    """)
+    cur.execute("SELECT name FROM schema_migrations")
+    aplicadas = {r[0] for r in cur.fetchall()}
+    novas = []
+    for name, sql in MIGRATIONS:
+        if name not in aplicadas:
+            cur.execute(sql)
+            cur.execute("INSERT INTO schema_migrations (name) VALUES (%s)", (name,))
+            novas.append(name)
+    conn.commit()
+    cur.close()
+    return novas
+
+def ensure_schema(pool):
+    global _schema_ready
+    with _schema_lock:
+        if _schema_ready:
+            return
+        conn = pool.getconn()
+        try:
+            novas = run_migrations(conn)
+            if novas:
+                print(f"Migrações aplicadas: {', '.join(novas)}", flush=True)
+            _schema_ready = True
+        except Exception as e:
+            print(f"Erro ao aplicar migrações: {e}", flush=True)
+        finally:
+            pool.putconn(conn)
+
+def process_with_ai(text, timeout=AI_TIMEOUT):
     try:
         completion = client.chat.completions.create(
             model="llama-3.3-70b-versatile",
@@ -34,7 +732,7 @@ def process_with_ai(text):
                         "Você é um assistente financeiro. Retorne APENAS JSON.\n"
                         "1. Gasto (Dinheiro/Débito/Pix): {'action': 'add_expense', 'amount': float, 'category': str, 'description': str, 'bank': str}\n"
                         "2. Receita: {'action': 'add_income', 'amount': float, 'bank': str, 'description': str}\n"
-                        "3. Saldo: {'action': 'get_balance', 'bank': str}\n"
+                        "3. Saldo: {'action': 'get_balance', 'bank': str, 'date': 'DD/MM/AAAA' só se pedir o saldo em uma data passada, senão ''}\n"
                         "4. Fatura Simples ou Conta futura: {'action': 'add_bill', 'amount': float, 'description': str, 'month': 'MÊS EM PORTUGUÊS', 'category': str}\n"
                         "5. Compra Cartão de Crédito (1x ou Parcelado): {'action': 'add_credit_card_purchase', 'amount': float, 'installments': int, 'description': str, 'card': str, 'category': str}\n"
                         "6. Listar Contas/Faturas: {'action': 'list_bills', 'month': 'MÊS EM PORTUGUÊS'}\n"
@@ -56,23 +754,1719 @@ def process_with_ai(text):
                         "22. Informar Apenas o Banco: {'action': 'provide_bank', 'bank': str}\n"
                         "23. Criar Banco: {'action': 'create_bank', 'bank': str}\n"
                         "24. Alterar Banco: {'action': 'update_bank', 'old_bank': str, 'new_bank': str}\n"
+                        "25. Exportar Extrato/Histórico: {'action': 'export_data', 'format': 'csv'|'xlsx', 'month': 'MÊS EM PORTUGUÊS' ou '' para todo o histórico}\n"
                         "Outros: {'action': 'chat'}"
                     )
                 },
                 {"role": "user", "content": text}
             ],
             response_format={"type": "json_object"},
-            timeout=15
+            timeout=timeout
         )
         return json.loads(completion.choices[0].message.content)
     except Exception as e:
         print(f"Erro na IA: {e}", flush=True)
+        metrics.inc('zap_ai_failures_total')
+        return None
+
+# --- PARSER LOCAL (CAMINHO RÁPIDO SEM IA) ---
+# Reconhece os comandos mais frequentes sem chamar a Groq. Tudo o que for ambíguo
+# retorna None e segue para process_with_ai.
+MESES_NORMALIZADOS = {
+    'janeiro': 'Janeiro', 'fevereiro': 'Fevereiro', 'marco': 'Março', 'abril': 'Abril',
+    'maio': 'Maio', 'junho': 'Junho', 'julho': 'Julho', 'agosto': 'Agosto',
+    'setembro': 'Setembro', 'outubro': 'Outubro', 'novembro': 'Novembro', 'dezembro': 'Dezembro'
+}
+
+RE_VALOR = r'(?:r\$\s*)?(\d{1,3}(?:\.\d{3})+(?:,\d{1,2})?|\d+(?:[.,]\d{1,2})?)'
+RE_MES = r'(' + '|'.join(MESES_NORMALIZADOS) + r')'
+
+RE_SALDO = re.compile(r'^(?:qual\s+(?:e\s+)?(?:o\s+)?|ver\s+(?:o\s+)?|meu\s+|mostrar?\s+(?:o\s+)?)?saldos?(?:\s+(?:do|da|no|na|em)\s+([a-z0-9 ]{2,30}))?$')
+RE_DATA_SALDO = re.compile(r'\s+(?:em|no\s+dia|ate\s+o\s+dia|ate|dia)\s+(\d{1,2}(?:/\d{1,2}(?:/\d{2,4})?|\s+de\s+' + RE_MES + r'(?:\s+de\s+\d{4})?))$')
+RE_QUANTO_TENHO = re.compile(r'^quanto\s+(?:eu\s+)?tenho(?:\s+(?:no|na|em)\s+([a-z0-9 ]{2,30}))?$')
+RE_METAS = re.compile(r'^(?:listar|lista|ver|mostrar?|minhas|quais\s+(?:sao\s+)?(?:as\s+)?(?:minhas\s+)?)?\s*(?:as\s+|todas\s+as\s+)?metas$')
+RE_CONTAS = re.compile(r'^(?:listar|lista|ver|mostrar?|minhas|quais\s+(?:sao\s+)?(?:as\s+)?(?:minhas\s+)?)?\s*(?:as\s+)?(?:contas|faturas|contas\s+a\s+pagar)(?:\s+(?:de|do\s+mes\s+de|em|para)\s+' + RE_MES + r')?$')
+RE_APAGAR_ULTIMO = re.compile(r'^(?:apagar?|apague|excluir|exclua|deletar?|delete|remover?|remova)\s+(?:o\s+)?ultimo(?:\s+(?:gasto|lancamento|registro))?$')
+RE_GASTO = re.compile(
+    r'^(?:gastei|paguei|comprei)\s+' + RE_VALOR + r'(?:\s+reais)?'
+    r'\s+(?:no|na|nos|nas|em|de|com)\s+([a-z0-9]+(?: [a-z0-9]+){0,2}?)'
+    r'(?:\s+(?:pelo|pela|via|do\s+banco|no\s+banco|usando\s+o|usando\s+a)\s+([a-z]{2,}(?: [a-z]+){0,2}))?$'
+)
+# Cartão, parcelas, contas e datas mudam a ação (compra no cartão, conta a pagar, gasto em
+# outro dia), e "e"/vírgula indicam mais de um gasto na mesma frase: esses ficam com a IA
+RE_GASTO_PRECISA_IA = re.compile(
+    r',(?!\d)|\b(?:e|cartao|cartoes|credito|fatura|faturas|parcel\w*|\d+\s*x|vezes|conta|contas|boleto'
+    r'|ontem|anteontem|hoje|amanha|semana|mes|dia|' + '|'.join(MESES_NORMALIZADOS) + r')\b|\d{1,2}/\d{1,2}'
+)
+RE_EXPORTAR = re.compile(r'^(?:exportar?|exporte|baixar|baixe)(?:\s+(?:o|os|meu|meus|minha|minhas))?(?:\s+(?:extrato|dados|historico|lancamentos|planilha|gastos))?'
+                         r'(?:\s+(?:(?:em|como|para)\s+)?(csv|xlsx|excel))?(?:\s+(?:de|do\s+mes\s+de|em)\s+' + RE_MES + r')?(?:\s+(?:(?:em|como|para)\s+)?(csv|xlsx|excel))?$')
+RE_BANCO_SOLTO = re.compile(r'^(?:(?:pelo|pela|no|na|do|da|banco|foi\s+(?:no|na|pelo|pela))\s+)?([a-z][a-z0-9 ]{1,29})$')
+
+def _sem_acento(c):
+    return unicodedata.normalize('NFD', c)[0]
+
+def _texto_base(text):
+    texto = re.sub(r'\s+', ' ', unicodedata.normalize('NFC', text or '').lower()).strip()
+    return re.sub(r'[!?.]+$', '', texto).strip()
+
+def normalize_text(text):
+    # Mantém um caractere por caractere do original, para recuperar trechos com acento
+    return ''.join(_sem_acento(c) for c in _texto_base(text))
+
+def _parse_valor(valor):
+    if ',' in valor:
+        valor = valor.replace('.', '').replace(',', '.')
+    elif re.fullmatch(r'\d{1,3}(?:\.\d{3})+', valor):
+        valor = valor.replace('.', '')
+    return float(valor)
+
+def parse_local(text, pending=False):
+    original = _texto_base(text)
+    texto = normalize_text(original)
+    if not texto:
         return None
 
+    # "saldo em 30 de setembro": tira a data do fim antes de reconhecer o pedido de saldo
+    m_data = RE_DATA_SALDO.search(texto)
+    if m_data:
+        prefixo = texto[:m_data.start()]
+        m = RE_SALDO.match(prefixo) or RE_QUANTO_TENHO.match(prefixo)
+        if m:
+            return {'action': 'get_balance', 'bank': (m.group(1) or '').strip(), 'date': m_data.group(1)}
+
+    m = RE_SALDO.match(texto) or RE_QUANTO_TENHO.match(texto)
+    if m:
+        return {'action': 'get_balance', 'bank': (m.group(1) or '').strip()}
+
+    if RE_METAS.match(texto):
+        return {'action': 'list_goals'}
+
+    m = RE_CONTAS.match(texto)
+    if m:
+        return {'action': 'list_bills', 'month': MESES_NORMALIZADOS.get(m.group(1), '') if m.group(1) else ''}
+
+    if RE_APAGAR_ULTIMO.match(texto):
+        return {'action': 'delete_last'}
+
+    m = RE_EXPORTAR.match(texto)
+    if m:
+        formato = m.group(1) or m.group(3) or 'csv'
+        return {'action': 'export_data', 'format': 'csv' if formato == 'csv' else 'xlsx',
+                'month': MESES_NORMALIZADOS.get(m.group(2), '') if m.group(2) else ''}
+
+    m = RE_GASTO.match(texto)
+    if m and not RE_GASTO_PRECISA_IA.search(texto):
+        local = original[m.start(2):m.end(2)].strip()
+        banco = original[m.start(3):m.end(3)].strip() if m.group(3) else ''
+        return {
+            'action': 'add_expense',
+            'amount': _parse_valor(m.group(1)),
+            'category': local,
+            'description': local.capitalize(),
+            'bank': banco
+        }
+
+    # Só tratamos uma mensagem curta como nome de banco quando há um gasto aguardando o banco
+    if pending and not re.search(r'\d', texto) and len(texto.split()) <= 3:
+        m = RE_BANCO_SOLTO.match(texto)
+        if m:
+            return {'action': 'provide_bank', 'bank': m.group(1).strip()}
+
+    return None
+
+# --- CACHE DAS RESPOSTAS DA IA ---
+# A chave é o texto normalizado com os números trocados por '#'; os valores numéricos
+# da resposta que vieram da mensagem são guardados como posições e recolocados no acerto.
+RE_NUMERO = re.compile(r'\d+(?:[.,]\d+)*')
+
+def _ai_cache_key(text):
+    texto = normalize_text(text)
+    numeros = [_parse_valor(n) for n in RE_NUMERO.findall(texto)]
+    return RE_NUMERO.sub('#', texto), numeros
+
+def _ai_cache_template(data, numeros):
+    modelo = {}
+    for key, value in data.items():
+        if isinstance(value, bool) or value is None:
+            modelo[key] = value
+        elif isinstance(value, (int, float)):
+            # Número calculado pela IA (ex.: 3x de 100 = 300) só vale para esta mensagem
+            if float(value) not in numeros:
+                return None
+            # Valor repetido na mensagem ("10 em 10x") não diz qual posição o campo ocupa
+            if numeros.count(float(value)) > 1:
+                return None
+            modelo[key] = {'__num__': numeros.index(float(value)), 'int': isinstance(value, int)}
+        elif isinstance(value, str):
+            # Texto com dígitos (ex.: "Aluguel 2") não pode ser reaproveitado para outra mensagem
+            if re.search(r'\d', value):
+                return None
+            modelo[key] = value
+        else:
+            return None
+    return modelo
+
+def _ai_cache_fill(modelo, numeros):
+    data = {}
+    for key, value in modelo.items():
+        if isinstance(value, dict):
+            if value['__num__'] >= len(numeros):
+                return None
+            num = numeros[value['__num__']]
+            data[key] = int(num) if value['int'] else num
+        else:
+            data[key] = value
+    return data
+
+class AICache:
+    def __init__(self, maxsize, ttl, shared=False):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.shared = shared
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._stores = 0
+        self._stats = {'hits': 0, 'shared_hits': 0, 'misses': 0, 'evictions': 0, 'expired': 0, 'stores': 0, 'skipped': 0}
+
+    # O backend compartilhado usa o cursor da mensagem em andamento (como o
+    # PendingActionStore), sem pedir uma segunda conexão ao pool. O savepoint impede que
+    # uma falha no cache aborte a transação da mensagem.
+    def _shared_get(self, cur, key):
+        cur.execute("SAVEPOINT ai_cache")
+        try:
+            cur.execute("SELECT result FROM ai_cache WHERE key = %s AND expires_at > now()", (key,))
+            row = cur.fetchone()
+        except psycopg2.Error:
+            cur.execute("ROLLBACK TO SAVEPOINT ai_cache")
+            raise
+        cur.execute("RELEASE SAVEPOINT ai_cache")
+        if not row:
+            return None
+        return row[0] if isinstance(row[0], dict) else json.loads(row[0])
+
+    def _shared_set(self, cur, key, modelo, limpar):
+        cur.execute("SAVEPOINT ai_cache")
+        try:
+            cur.execute("""
+                INSERT INTO ai_cache (key, result, expires_at) VALUES (%s, %s, now() + %s * INTERVAL '1 second')
+                ON CONFLICT (key) DO UPDATE SET result = EXCLUDED.result, expires_at = EXCLUDED.expires_at
+            """, (key, json.dumps(modelo), self.ttl))
+            if limpar:
+                cur.execute("DELETE FROM ai_cache WHERE expires_at <= now()")
+        except psycopg2.Error:
+            cur.execute("ROLLBACK TO SAVEPOINT ai_cache")
+            raise
+        cur.execute("RELEASE SAVEPOINT ai_cache")
+        cur.connection.commit()
+
+    def _local_put(self, key, modelo):
+        with self._lock:
+            self._items[key] = (modelo, time.monotonic() + self.ttl)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def get(self, text, cur=None):
+        key, numeros = _ai_cache_key(text)
+        modelo = None
+        with self._lock:
+            item = self._items.get(key)
+            if item:
+                if item[1] > time.monotonic():
+                    self._items.move_to_end(key)
+                    modelo = item[0]
+                else:
+                    del self._items[key]
+                    self._stats['expired'] += 1
+        origem = 'hits'
+        if modelo is None and self.shared and cur is not None:
+            try:
+                modelo = self._shared_get(cur, key)
+            except Exception as e:
+                print(f"Erro no cache compartilhado da IA: {e}", flush=True)
+            if modelo is not None:
+                origem = 'shared_hits'
+                self._local_put(key, modelo)
+        data = _ai_cache_fill(modelo, numeros) if modelo is not None else None
+        with self._lock:
+            self._stats[origem if data is not None else 'misses'] += 1
+        return data
+
+    def set(self, text, data, cur=None):
+        # Falhas (None) ou respostas inválidas nunca entram no cache
+        if not isinstance(data, dict) or not data.get('action'):
+            return
+        key, numeros = _ai_cache_key(text)
+        modelo = _ai_cache_template(data, numeros)
+        if modelo is None:
+            with self._lock:
+                self._stats['skipped'] += 1
+            return
+        self._local_put(key, modelo)
+        with self._lock:
+            self._stats['stores'] += 1
+            self._stores += 1
+            limpar = self._stores % 100 == 0
+        if self.shared and cur is not None:
+            try:
+                self._shared_set(cur, key, modelo, limpar)
+            except Exception as e:
+                print(f"Erro no cache compartilhado da IA: {e}", flush=True)
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+            s['size'] = len(self._items)
+        s['max_size'] = self.maxsize
+        s['shared'] = self.shared
+        return s
+
+ai_cache = AICache(AI_CACHE_SIZE, AI_CACHE_TTL, shared=AI_CACHE_SHARED)
+
+# --- PRAZO, DISJUNTOR E MODO DEGRADADO DA IA ---
+class AIUnavailable(Exception):
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+class CircuitBreaker:
+    """Abre depois de N falhas seguidas; após reset_timeout deixa passar uma chamada de teste."""
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._stats = {'trips': 0, 'rejected': 0, 'probes': 0, 'failures': 0, 'successes': 0}
+
+    def _pode_testar(self):
+        return self.state == 'open' and time.monotonic() - self._opened_at >= self.reset_timeout
+
+    def would_allow(self):
+        with self._lock:
+            return self.state == 'closed' or (self._pode_testar() and not self._probe_in_flight)
+
+    def allow(self):
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self._pode_testar():
+                self.state = 'half_open'
+            if self.state == 'half_open' and not self._probe_in_flight:
+                self._probe_in_flight = True
+                self._stats['probes'] += 1
+                return True
+            self._stats['rejected'] += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._stats['successes'] += 1
+            self._failures = 0
+            self._probe_in_flight = False
+            self.state = 'closed'
+
+    def record_failure(self):
+        with self._lock:
+            self._stats['failures'] += 1
+            self._failures += 1
+            self._probe_in_flight = False
+            if self.state == 'half_open' or (self.state == 'closed' and self._failures >= self.failure_threshold):
+                if self.state != 'open':
+                    self._stats['trips'] += 1
+                self.state = 'open'
+                self._opened_at = time.monotonic()
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+            s['state'] = self.state
+            s['state_code'] = {'closed': 0, 'half_open': 1, 'open': 2}[self.state]
+            s['consecutive_failures'] = self._failures
+        return s
+
+ai_breaker = CircuitBreaker(AI_BREAKER_FAILURES, AI_BREAKER_RESET)
+_deadline_local = threading.local()
+
+def start_deadline(segundos=UPDATE_DEADLINE_SECONDS):
+    _deadline_local.prazo = time.monotonic() + segundos
+
+def clear_deadline():
+    _deadline_local.prazo = None
+
+def ai_timeout_for_update():
+    # Timeout da IA limitado ao que sobra do prazo da mensagem, guardando uma folga para o banco e a resposta
+    prazo = getattr(_deadline_local, 'prazo', None)
+    if prazo is None:
+        return AI_TIMEOUT
+    restante = prazo - time.monotonic() - AI_DEADLINE_RESERVE
+    return min(AI_TIMEOUT, restante) if restante >= AI_MIN_TIMEOUT else None
+
+def call_ai(text):
+    timeout = ai_timeout_for_update()
+    if timeout is None:
+        metrics.inc('zap_ai_unavailable_total', reason='deadline')
+        raise AIUnavailable('deadline')
+    if not ai_breaker.allow():
+        metrics.inc('zap_ai_unavailable_total', reason='circuit_open')
+        raise AIUnavailable('circuit_open')
+    data = process_with_ai(text, timeout=timeout)
+    if data is None:
+        ai_breaker.record_failure()
+        metrics.inc('zap_ai_unavailable_total', reason='error')
+        raise AIUnavailable('error')
+    ai_breaker.record_success()
+    return data
+
+def is_replayed(message):
+    raw = message.json if isinstance(message.json, dict) else json.loads(message.json or '{}')
+    return bool(raw.get('_deferred'))
+
+def defer_message(cur, message):
+    raw = message.json if isinstance(message.json, str) else json.dumps(message.json)
+    cur.execute("INSERT INTO deferred_messages (chat_id, message_json) VALUES (%s, %s)", (int(message.chat.id), raw))
+    cur.connection.commit()
+    metrics.inc('zap_ai_deferred_total')
+
+class DeferredDrainer:
+    """Reenvia as mensagens guardadas no modo degradado quando a IA volta a responder.
+
+    Roda uma thread por worker. As mensagens voltam pela fila do webhook (ordem por chat
+    preservada) e a primeira delas funciona como chamada de teste do disjuntor.
+    """
+
+    def __init__(self, poll, max_age, batch=20):
+        self.poll = poll
+        self.max_age = max_age
+        self.batch = batch
+        self.pid = None
+        self._lock = threading.Lock()
+        self._stats = {'replayed': 0, 'expired': 0}
+
+    def ensure_started(self):
+        if self.pid == os.getpid():
+            return
+        with self._lock:
+            if self.pid == os.getpid():
+                return
+            threading.Thread(target=self._run, name="deferred-drainer", daemon=True).start()
+            self.pid = os.getpid()
+
+    def _run(self):
+        while True:
+            time.sleep(self.poll)
+            try:
+                if ai_breaker.would_allow():
+                    self.drain_once(1 if ai_breaker.state != 'closed' else self.batch)
+            except Exception as e:
+                print(f"Erro ao reprocessar mensagens adiadas: {e}", flush=True)
+
+    def drain_once(self, limite):
+        conn = get_db()
+        try:
+            cur = conn.cursor()
+            cur.execute("DELETE FROM deferred_messages WHERE created_at < now() - %s * INTERVAL '1 second'", (self.max_age,))
+            expiradas = cur.rowcount
+            # SKIP LOCKED: cada mensagem é reenviada por um único worker
+            cur.execute("""
+                DELETE FROM deferred_messages WHERE id IN (
+                    SELECT id FROM deferred_messages ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED
+                ) RETURNING id, message_json
+            """, (limite,))
+            linhas = sorted(cur.fetchall())
+            conn.commit()
+            cur.close()
+        finally:
+            release_db(conn)
+        reenviar = []
+        for deferred_id, raw in linhas:
+            msg = json.loads(raw)
+            # Uma mensagem pode ser adiada de novo se a IA cair outra vez: a idade conta da data original
+            if time.time() - msg.get('date', time.time()) > self.max_age:
+                expiradas += 1
+            else:
+                reenviar.append((deferred_id, msg))
+        with self._lock:
+            self._stats['expired'] += expiradas
+            self._stats['replayed'] += len(reenviar)
+        for deferred_id, msg in reenviar:
+            # Marca o reenvio: se a IA falhar de novo, a mensagem volta para a fila sem avisar o usuário outra vez
+            msg['_deferred'] = True
+            update = telebot.types.Update.de_json({'update_id': -deferred_id, 'message': msg})
+            if WEBHOOK_ASYNC:
+                dispatcher.submit(update)
+            else:
+                bot.process_new_updates([update])
+        return len(reenviar)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+deferred_drainer = DeferredDrainer(AI_DEFERRED_POLL, AI_DEFERRED_MAX_AGE)
+
+def cached_process_with_ai(text, cur=None):
+    data = ai_cache.get(text, cur)
+    if data is not None:
+        return data
+    data = call_ai(text)
+    ai_cache.set(text, data, cur)
+    return data
+
+parser_stats = {'local': 0, 'ai': 0}
+_parser_stats_lock = threading.Lock()
+
+def _confirmar_categoria_local(data, cur, user_id):
+    # O local do gasto só vale como categoria se bater com uma categoria do usuário
+    # ou for uma palavra só; "mercado do bairro" e afins ficam com a IA
+    if not data or data.get('action') != 'add_expense':
+        return data
+    if cur is not None:
+        status, categoria = name_resolver.resolve(cur, user_id, 'category', data['category'])
+        if status == 'ok':
+            data['category'] = categoria[1]
+            return data
+    return data if len(data['category'].split()) == 1 else None
+
+def interpret_message(text, pending=False, cur=None, user_id=None):
+    data = _confirmar_categoria_local(parse_local(text, pending=pending), cur, user_id)
+    origem = 'local' if data else 'ai'
+    with _parser_stats_lock:
+        parser_stats[origem] += 1
+    if data is None:
+        data = cached_process_with_ai(text, cur)
+    return data
+
+def get_parser_stats():
+    with _parser_stats_lock:
+        s = dict(parser_stats)
+    total = s['local'] + s['ai']
+    s['local_hit_ratio'] = round(s['local'] / total, 4) if total else 0.0
+    return s
+
+# --- RELATÓRIOS POR PERÍODO ---
+# Todos os relatórios usam intervalos semiabertos [inicio, fim) direto nas colunas de data,
+# assim o índice (user_id, date) atende a consulta sem calcular nada por linha.
+MESES_PT = {1: 'Janeiro', 2: 'Fevereiro', 3: 'Março', 4: 'Abril', 5: 'Maio', 6: 'Junho',
+            7: 'Julho', 8: 'Agosto', 9: 'Setembro', 10: 'Outubro', 11: 'Novembro', 12: 'Dezembro'}
+MESES_EN = {'january': 1, 'february': 2, 'march': 3, 'april': 4, 'may': 5, 'june': 6, 'july': 7,
+            'august': 8, 'september': 9, 'october': 10, 'november': 11, 'december': 12,
+            'jan': 1, 'feb': 2, 'mar': 3, 'apr': 4, 'jun': 6, 'jul': 7, 'aug': 8, 'sep': 9,
+            'oct': 10, 'nov': 11, 'dec': 12}
+
+PERIODOS_PT = {'today': 'Hoje', 'yesterday': 'Ontem', 'week': 'Esta semana', 'month': 'Este mês'}
+
+ACOES_DE_ESCRITA = {
+    'create_bank', 'update_bank', 'delete_bank', 'create_category', 'update_category', 'delete_category',
+    'delete_last', 'delete_bill', 'add_credit_card_purchase', 'add_income', 'add_expense', 'add_bill',
+    'pay_bill', 'update_bill', 'set_goal'
+}
+
+ACOES_CONHECIDAS = ACOES_DE_ESCRITA | {
+    'get_balance', 'list_goals', 'check_goal', 'list_bills', 'get_report', 'report_category',
+    'total_bills', 'list_categories', 'provide_bank', 'chat', 'deferred', 'export_data'
+}
+
+def month_range(ano, mes):
+    inicio = datetime(ano, mes, 1)
+    fim = datetime(ano + 1, 1, 1) if mes == 12 else datetime(ano, mes + 1, 1)
+    return inicio, fim
+
+def resolve_month(mes, hoje):
+    """Converte o mês pedido em (ano, mês, rótulo) levando o ano em conta.
+
+    Sem ano explícito, escolhe a ocorrência mais próxima olhando para frente:
+    "janeiro" em dezembro é o janeiro seguinte, mas "outubro" em novembro
+    continua sendo o outubro que acabou de passar (até 3 meses para trás).
+    """
+    texto = normalize_text(str(mes or ''))
+    ano = re.search(r'\b(20\d{2})\b', texto)
+    nomes = {normalize_text(v): k for k, v in MESES_PT.items()}
+    nomes.update({normalize_text(k): v for k, v in MESES_EN.items()})
+    mes_alvo = next((n for nome, n in nomes.items() if re.search(rf'\b{nome}\b', texto)), None)
+    if mes_alvo is None:
+        mes_alvo = hoje.month
+        ano_alvo = int(ano.group(1)) if ano else hoje.year
+    elif ano:
+        ano_alvo = int(ano.group(1))
+    else:
+        ano_alvo = hoje.year
+        if (mes_alvo - hoje.month) % 12 <= 8:
+            ano_alvo += 1 if mes_alvo < hoje.month else 0
+        elif mes_alvo > hoje.month:
+            ano_alvo -= 1
+    rotulo = MESES_PT[mes_alvo] if ano_alvo == hoje.year else f"{MESES_PT[mes_alvo]}/{ano_alvo}"
+    return ano_alvo, mes_alvo, rotulo
+
+def period_range(periodo, hoje):
+    dia = datetime(hoje.year, hoje.month, hoje.day)
+    if periodo == 'today':
+        return dia, dia + timedelta(days=1)
+    if periodo == 'yesterday':
+        return dia - timedelta(days=1), dia
+    if periodo == 'week':
+        inicio = dia - timedelta(days=dia.weekday())
+        return inicio, inicio + timedelta(days=7)
+    return month_range(hoje.year, hoje.month)
+
+def _report_spending(cur, user_id, inicio, fim, category=None):
+    sql = """
+        SELECT upper(COALESCE(category, '')), SUM(amount), COUNT(*)
+        FROM transactions
+        WHERE user_id = %s AND date >= %s AND date < %s AND COALESCE(type, 'expense') = 'expense'
+    """
+    params = [user_id, inicio, fim]
+    if category:
+        sql += " AND upper(category) = %s"
+        params.append(category.upper())
+    cur.execute(sql + " GROUP BY 1 ORDER BY 2 DESC", params)
+    return [(cat, float(total), int(qtd)) for cat, total, qtd in cur.fetchall()]
+
+def _report_bills(cur, user_id, inicio, fim):
+    cur.execute("""
+        SELECT description, amount, NULL FROM unpaid_bills
+        WHERE user_id = %s AND is_paid = false AND due_date >= %s AND due_date < %s
+        UNION ALL
+        SELECT description, amount, card_name FROM scheduled_expenses
+        WHERE user_id = %s AND is_active = true AND due_date >= %s AND due_date < %s
+    """, (user_id, inicio, fim, user_id, inicio, fim))
+    return [(desc, float(amount), card) for desc, amount, card in cur.fetchall()]
+
+def run_report(cur, user_id, kind, inicio, fim, category=None):
+    # Sem cache: as escritas vêm de vários workers e do dashboard, e com o índice
+    # (user_id, date) a consulta já é barata
+    if kind == 'spending':
+        gastos = _report_spending(cur, user_id, inicio, fim, category)
+        result = {'categories': gastos, 'total': sum(g[1] for g in gastos), 'count': sum(g[2] for g in gastos)}
+        if not category:
+            contas = _report_bills(cur, user_id, inicio, fim)
+            result['bills_total'] = sum(c[1] for c in contas)
+            result['bills_count'] = len(contas)
+    elif kind == 'bills':
+        contas = _report_bills(cur, user_id, inicio, fim)
+        result = {'bills': contas, 'total': sum(c[1] for c in contas), 'count': len(contas)}
+    else:
+        raise ValueError(f"Relatório desconhecido: {kind}")
+    return result
+
+# --- HISTÓRICO DE SALDOS (LEDGER) ---
+# Toda mudança de saldo vira um lançamento em account_ledger, ligado à transação que o
+# causou. accounts.balance continua sendo o saldo atual (atualizado na mesma transação) e,
+# a cada LEDGER_SNAPSHOT_EVERY lançamentos, a conta ganha um snapshot. O saldo em uma data
+# é o último snapshot antes dela mais os lançamentos entre os dois.
+def ledger_post(cur, account_id, user_id, amount, kind, transaction_id=None):
+    """Lança o valor no extrato da conta e devolve o novo saldo (None se a conta não existe mais)."""
+    # O UPDATE trava a linha da conta, então id e created_at crescem juntos dentro de cada conta
+    cur.execute("""
+        UPDATE accounts SET balance = balance + %s, ledger_entries = ledger_entries + 1
+        WHERE id = %s RETURNING balance, ledger_entries
+    """, (amount, account_id))
+    linha = cur.fetchone()
+    if linha is None:
+        return None
+    saldo, lancamentos = linha
+    cur.execute("""
+        INSERT INTO account_ledger (account_id, user_id, transaction_id, amount, kind, created_at)
+        VALUES (%s, %s, %s, %s, %s, clock_timestamp() AT TIME ZONE 'UTC' - INTERVAL '3 hours')
+        RETURNING id, created_at
+    """, (account_id, user_id, transaction_id, amount, kind))
+    ledger_id, criado_em = cur.fetchone()
+    if lancamentos % LEDGER_SNAPSHOT_EVERY == 0:
+        cur.execute("INSERT INTO account_snapshots (account_id, as_of, ledger_id, balance) VALUES (%s, %s, %s, %s)",
+                    (account_id, criado_em, ledger_id, saldo))
+    return saldo
+
+def reverse_transaction(cur, user_id, transaction_id):
+    """Estorna o efeito de uma transação nos saldos. Retorna [(banco, valor estornado)]."""
+    cur.execute("""
+        SELECT l.account_id, a.bank_name, SUM(l.amount)
+        FROM account_ledger l JOIN accounts a ON a.id = l.account_id
+        WHERE l.transaction_id = %s
+        GROUP BY 1, 2
+    """, (transaction_id,))
+    estornos = []
+    for account_id, banco, soma in cur.fetchall():
+        if soma:
+            ledger_post(cur, account_id, user_id, -soma, 'reversal', transaction_id)
+            estornos.append((banco, -soma))
+    return estornos
+
+def balances_at(cur, user_id, limite):
+    """Saldo de cada conta antes de `limite` (exclusivo): snapshot mais recente + lançamentos seguintes."""
+    cur.execute("""
+        SELECT a.bank_name,
+               COALESCE(s.balance, 0) + COALESCE((
+                   SELECT SUM(l.amount) FROM account_ledger l
+                   WHERE l.account_id = a.id AND l.created_at >= COALESCE(s.as_of, '-infinity')
+                     AND l.created_at < %(limite)s AND l.id > COALESCE(s.ledger_id, 0)
+               ), 0)
+        FROM accounts a
+        LEFT JOIN LATERAL (
+            SELECT balance, as_of, ledger_id FROM account_snapshots
+            WHERE account_id = a.id AND as_of < %(limite)s
+            ORDER BY as_of DESC, ledger_id DESC LIMIT 1
+        ) s ON true
+        WHERE a.user_id = %(user_id)s
+        ORDER BY a.bank_name
+    """, {'user_id': user_id, 'limite': limite})
+    return [(banco, float(saldo)) for banco, saldo in cur.fetchall()]
+
+def ledger_start(cur, user_id):
+    cur.execute("SELECT MIN(created_at) FROM account_ledger WHERE user_id = %s", (user_id,))
+    return cur.fetchone()[0]
+
+def resolve_balance_date(texto, hoje):
+    """Converte "30/09", "30/09/2025", "30 de setembro" ou "2025-09-30" em date (None se inválida).
+
+    Sem ano, usa a ocorrência mais recente que não esteja no futuro.
+    """
+    texto = normalize_text(str(texto or ''))
+    m = re.fullmatch(r'(\d{4})-(\d{1,2})-(\d{1,2})', texto)
+    if m:
+        ano, mes, dia = (int(x) for x in m.groups())
+    else:
+        m = re.fullmatch(r'(\d{1,2})(?:/(\d{1,2})|\s+de\s+([a-z]+))(?:(?:/|\s+de\s+)(\d{2,4}))?', texto)
+        if not m:
+            return None
+        dia = int(m.group(1))
+        if m.group(2):
+            mes = int(m.group(2))
+        else:
+            nomes = {normalize_text(v): k for k, v in MESES_PT.items()}
+            mes = nomes.get(m.group(3))
+            if mes is None:
+                return None
+        ano = int(m.group(4)) if m.group(4) else None
+        if ano is not None and ano < 100:
+            ano += 2000
+    try:
+        data = date(ano or hoje.year, mes, dia)
+        if ano is None and data > hoje.date():
+            data = date(hoje.year - 1, mes, dia)
+    except ValueError:
+        return None
+    return data
+
+# --- RESOLUÇÃO DE NOMES DE BANCOS E CATEGORIAS ---
+# Em vez de ILIKE '%nome%' (que não usa índice e pode pegar várias linhas, ex.: "BB" e "BBVA"),
+# o texto livre é comparado em memória com os nomes do usuário e vira um único id.
+RESOLVER_QUERIES = {
+    'bank': ("SELECT id, bank_name FROM accounts WHERE user_id = %s",),
+    'category': (
+        "SELECT id, name FROM categories WHERE user_id = %s",
+        "SELECT DISTINCT NULL::integer, category FROM category_month_spend WHERE user_id = %s",
+    ),
+    'goal': ("SELECT NULL::integer, category FROM category_goals WHERE user_id = %s",),
+}
+
+def _trigramas(texto):
+    grams = set()
+    for palavra in texto.split():
+        palavra = f"  {palavra} "
+        grams.update(palavra[i:i + 3] for i in range(len(palavra) - 2))
+    return grams
+
+def _similaridade(a, b):
+    ga, gb = _trigramas(a), _trigramas(b)
+    return len(ga & gb) / len(ga | gb) if ga and gb else 0.0
+
+class NameResolver:
+    def __init__(self, maxsize, ttl, min_similarity=0.4, ambiguity_margin=0.1):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.min_similarity = min_similarity
+        self.ambiguity_margin = ambiguity_margin
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'loads': 0, 'reloads': 0, 'invalidations': 0, 'ambiguous': 0, 'not_found': 0, 'confirm': 0, 'stale': 0}
+
+    def _load(self, cur, user_id, kind):
+        nomes = {}
+        for sql in RESOLVER_QUERIES[kind]:
+            cur.execute(sql, (user_id,))
+            for item_id, nome in cur.fetchall():
+                if not nome:
+                    continue
+                chave = normalize_text(nome)
+                # Prefere a linha com id (tabela de cadastro) quando o mesmo nome aparece duas vezes
+                if chave not in nomes or (nomes[chave][0] is None and item_id is not None):
+                    nomes[chave] = (item_id, nome)
+        return list(nomes.items())
+
+    def candidates(self, cur, user_id, kind, fresh=False):
+        key = (user_id, kind)
+        with self._lock:
+            item = self._items.get(key)
+            if item and not fresh and item[1] > time.monotonic():
+                self._items.move_to_end(key)
+                self._stats['hits'] += 1
+                return item[0]
+        itens = self._load(cur, user_id, kind)
+        with self._lock:
+            self._stats['loads'] += 1
+            self._items[key] = (itens, time.monotonic() + self.ttl)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+        return itens
+
+    def resolve(self, cur, user_id, kind, texto, strict=False, fresh=False):
+        """Retorna ('ok', (id, nome)), ('ambiguous', [nomes]) ou ('not_found', None).
+
+        Com strict=True (ações que alteram ou apagam), um nome que só bateu por palavras
+        ou por semelhança volta como ('confirm', [nome]) para o usuário confirmar.
+        """
+        alvo = normalize_text(texto)
+        status, valor, exato = self._match(self.candidates(cur, user_id, kind, fresh=fresh), alvo)
+        if status != 'ok' and not fresh:
+            # O cache é por worker: o nome pode ter sido criado em outro worker ou no dashboard
+            with self._lock:
+                self._stats['reloads'] += 1
+            status, valor, exato = self._match(self.candidates(cur, user_id, kind, fresh=True), alvo)
+        if status == 'ok' and strict and not exato:
+            status, valor = 'confirm', [valor[1]]
+        if status != 'ok':
+            with self._lock:
+                self._stats[status] += 1
+        return status, valor
+
+    def _match(self, itens, alvo):
+        if not alvo or not itens:
+            return 'not_found', None, False
+
+        exatos = [v for chave, v in itens if chave == alvo]
+        if exatos:
+            return 'ok', exatos[0], True
+
+        compacto = re.sub(r'[^a-z0-9]', '', alvo)
+        iguais = [v for chave, v in itens if re.sub(r'[^a-z0-9]', '', chave) == compacto]
+        if len(iguais) == 1:
+            return 'ok', iguais[0], True
+
+        # Palavras inteiras: "banco do brasil" acha "BANCO DO BRASIL PJ", mas "bb" não acha "BBVA".
+        # Só nesse sentido: "nubank antigo" não pode virar NUBANK
+        palavras = set(alvo.split())
+        contidos = [v for chave, v in itens if palavras <= set(chave.split())]
+        if len(contidos) == 1:
+            return 'ok', contidos[0], False
+        if len(contidos) > 1:
+            return 'ambiguous', sorted(v[1] for v in contidos), False
+
+        # Semelhança só contra nomes com pelo menos tantas palavras quanto o pedido (erros de
+        # digitação), nunca para encaixar um pedido mais longo em um nome mais curto
+        notas = sorted(((_similaridade(alvo, chave), v) for chave, v in itens if len(chave.split()) >= len(palavras)),
+                       key=lambda x: x[0], reverse=True)
+        if not notas or notas[0][0] < self.min_similarity:
+            return 'not_found', None, False
+        proximos = [v for nota, v in notas if nota >= self.min_similarity and notas[0][0] - nota < self.ambiguity_margin]
+        if len(proximos) > 1:
+            return 'ambiguous', sorted(v[1] for v in proximos), False
+        return 'ok', notas[0][1], False
+
+    def apply(self, cur, user_id, kind, texto, aplicar, strict=False):
+        """Resolve o nome e chama aplicar((id, nome)).
+
+        Se aplicar devolver False (o id do cache foi apagado em outro worker ou no
+        dashboard), recarrega os nomes e tenta mais uma vez antes de dar 'not_found'.
+        """
+        for fresh in (False, True):
+            status, valor = self.resolve(cur, user_id, kind, texto, strict=strict, fresh=fresh)
+            if status != 'ok' or aplicar(valor):
+                return status, valor
+            with self._lock:
+                self._stats['stale'] += 1
+        with self._lock:
+            self._stats['not_found'] += 1
+        return 'not_found', None
+
+    def invalidate(self, user_id):
+        with self._lock:
+            for key in [k for k in self._items if k[0] == user_id]:
+                del self._items[key]
+            self._stats['invalidations'] += 1
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+            s['size'] = len(self._items)
+        return s
+
+name_resolver = NameResolver(RESOLVER_CACHE_SIZE, RESOLVER_CACHE_TTL)
+
+def ask_to_pick(message, cur, user_id, data, campo, tipo, nomes):
+    # Guarda a ação para que a próxima mensagem (o nome escolhido) complete o pedido
+    data['_pending_field'] = campo
+    pending_user_actions.set(cur, user_id, data)
+    if len(nomes) == 1:
+        bot.reply_to(message, f"🤔 Você quis dizer o {tipo} **{nomes[0]}**? Se for, me mande o nome exato dele para confirmar.", parse_mode="Markdown")
+        return
+    opcoes = "\n".join(f"• {n}" for n in nomes)
+    bot.reply_to(message, f"🤔 Encontrei mais de um {tipo} parecido com **{data.get(campo)}**:\n{opcoes}\n\nQual deles você quis dizer?", parse_mode="Markdown")
+
+# --- IMPORTAÇÃO DE EXTRATOS (CSV/OFX) ---
+# O arquivo é lido em streaming do Telegram e gravado em lotes, então a memória usada
+# não depende do tamanho do extrato. Linhas que já existem em transactions (mesmo dia,
+# valor e descrição) são ignoradas, o que torna seguro reenviar o mesmo arquivo.
+COLUNAS_EXTRATO = {
+    'date': ('data', 'date', 'data lancamento', 'data de lancamento', 'data movimento', 'dt'),
+    'amount': ('valor', 'amount', 'value', 'valor (r$)', 'quantia'),
+    'description': ('descricao', 'description', 'title', 'titulo', 'historico', 'memo', 'lancamento', 'estabelecimento'),
+    'category': ('categoria', 'category'),
+}
+FORMATOS_DATA = ('%d/%m/%Y', '%Y-%m-%d', '%d/%m/%y', '%d-%m-%Y', '%Y/%m/%d')
+RE_FATURA_CARTAO = re.compile(r'(?<![a-z])(cartao|fatura|credito|credit ?card)(?![a-z])')
+
+import_semaphore = threading.BoundedSemaphore(max(1, IMPORT_MAX_CONCURRENT))
+
+def _iter_download(file_path, chunk_size=64 * 1024):
+    url = f"https://api.telegram.org/file/bot{TOKEN}/{file_path}"
+    with requests.get(url, stream=True, timeout=60) as resp:
+        resp.raise_for_status()
+        for chunk in resp.iter_content(chunk_size=chunk_size):
+            if chunk:
+                yield chunk
+
+def _iter_text(chunks):
+    decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    utf8 = True
+    for chunk in chunks:
+        if utf8:
+            pendente = decoder.getstate()[0]
+            try:
+                yield decoder.decode(chunk)
+                continue
+            except UnicodeDecodeError:
+                # Não é UTF-8: segue como Windows-1252, o padrão dos extratos dos bancos
+                utf8 = False
+                decoder = codecs.getincrementaldecoder('cp1252')(errors='replace')
+                chunk = pendente + chunk
+        yield decoder.decode(chunk)
+    try:
+        yield decoder.decode(b'', final=True)
+    except UnicodeDecodeError:
+        yield decoder.getstate()[0].decode('cp1252', errors='replace')
+
+def _iter_lines(textos):
+    resto = ''
+    for texto in textos:
+        resto += texto
+        *linhas, resto = resto.split('\n')
+        for linha in linhas:
+            yield linha.rstrip('\r')
+    if resto:
+        yield resto.rstrip('\r')
+
+def _parse_data_extrato(texto):
+    texto = (texto or '').strip()
+    if re.fullmatch(r'\d{8}.*', texto):
+        # Formato OFX: AAAAMMDD[HHMMSS[.XXX][-3:BRT]]
+        return datetime(int(texto[:4]), int(texto[4:6]), int(texto[6:8]))
+    for formato in FORMATOS_DATA:
+        try:
+            return datetime.strptime(texto[:10], formato)
+        except ValueError:
+            continue
+    return None
+
+def _parse_valor_extrato(texto):
+    texto = (texto or '').strip().replace('R$', '').replace(' ', '')
+    negativo = texto.startswith('-') or texto.endswith('-') or (texto.startswith('(') and texto.endswith(')'))
+    texto = texto.strip('-+()')
+    if not re.fullmatch(r'[\d.,]+', texto):
+        return None
+    if ',' in texto and '.' in texto and texto.rfind('.') > texto.rfind(','):
+        texto = texto.replace(',', '')  # formato 1,234.56
+    try:
+        valor = _parse_valor(texto)
+    except ValueError:
+        return None
+    return -valor if negativo else valor
+
+def _coluna_csv(row, indices, campo):
+    valor = row[indices[campo]].strip() if campo in indices and indices[campo] < len(row) else ''
+    if campo == 'date':
+        return _parse_data_extrato(valor)
+    if campo == 'amount':
+        return _parse_valor_extrato(valor)
+    return valor
+
+def iter_csv_rows(linhas, info=None):
+    linhas = iter(linhas)
+    cabecalho = next(linhas, '')
+    if info is not None:
+        info['cabecalho'] = normalize_text(cabecalho)
+    delimitador = ';' if cabecalho.count(';') > cabecalho.count(',') else ','
+    nomes = [normalize_text(c).strip('"') for c in next(csv.reader([cabecalho], delimiter=delimitador))]
+    indices = {}
+    for campo, aliases in COLUNAS_EXTRATO.items():
+        for i, nome in enumerate(nomes):
+            if nome in aliases:
+                indices[campo] = i
+                break
+    if 'date' not in indices or 'amount' not in indices:
+        raise ValueError("Não encontrei as colunas de data e valor no cabeçalho do CSV.")
+    for row in csv.reader(linhas, delimiter=delimitador):
+        if not row:
+            continue
+        yield {campo: _coluna_csv(row, indices, campo) for campo in COLUNAS_EXTRATO}
+
+RE_TAG_OFX = re.compile(r'<(/?)([A-Za-z0-9.]+)>([^<]*)')
+
+def iter_ofx_rows(textos, info=None):
+    estado = {'atual': None}
+
+    def consumir(pedaco):
+        for fecha, tag, valor in RE_TAG_OFX.findall(pedaco):
+            tag = tag.upper()
+            if tag == 'CREDITCARDMSGSRSV1' and info is not None:
+                info['cartao'] = True
+            elif tag == 'STMTTRN':
+                # Em OFX SGML o fechamento é opcional: uma nova abertura também encerra a anterior
+                if estado['atual']:
+                    yield estado['atual']
+                estado['atual'] = None if fecha else {}
+            elif estado['atual'] is not None and not fecha:
+                estado['atual'][tag] = valor.strip()
+
+    buffer = ''
+    for texto in textos:
+        buffer += texto
+        # Só processa até o último '<' para não cortar uma tag ou um valor ao meio
+        corte = buffer.rfind('<')
+        if corte > 0:
+            yield from consumir(buffer[:corte])
+            buffer = buffer[corte:]
+    yield from consumir(buffer)
+    if estado['atual']:
+        yield estado['atual']
+
+def _ofx_para_linha(trn):
+    return {
+        'date': _parse_data_extrato(trn.get('DTPOSTED')),
+        'amount': _parse_valor_extrato(trn.get('TRNAMT')),
+        'description': (trn.get('MEMO') or trn.get('NAME') or '').strip(),
+        'category': '',
+    }
+
+def _categoria_extrato(cur, user_id, linha):
+    if linha['category']:
+        status, categoria = name_resolver.resolve(cur, user_id, 'category', linha['category'])
+        return categoria[1].upper() if status == 'ok' else linha['category'].upper()
+    # Sem coluna de categoria: procura uma categoria do usuário citada na descrição
+    descricao = f" {normalize_text(linha['description'])} "
+    for chave, (_, nome) in name_resolver.candidates(cur, user_id, 'category'):
+        if chave and f" {chave} " in descricao:
+            return nome.upper()
+    return 'GERAL'
+
+def _flush_import(cur, user_id, lote):
+    cur.execute("TRUNCATE import_staging")
+    psycopg2.extras.execute_values(cur, """
+        INSERT INTO import_staging (date, amount, category, description, type) VALUES %s
+    """, lote, page_size=len(lote))
+    cur.execute("""
+        INSERT INTO transactions (user_id, date, amount, category, description, type)
+        SELECT %s, s.date, s.amount, s.category, s.description, s.type
+        FROM import_staging s
+        WHERE NOT EXISTS (
+            SELECT 1 FROM transactions t
+            WHERE t.user_id = %s AND t.date >= s.date AND t.date < s.date + INTERVAL '1 day'
+              AND t.amount = s.amount AND upper(t.description) = upper(s.description)
+        )
+    """, (user_id, user_id))
+    return cur.rowcount
+
+def import_statement(user_id, linhas, inverter_sinal=False, progresso=None):
+    resumo = {'lidas': 0, 'importadas': 0, 'duplicadas': 0, 'ignoradas': 0}
+    conn = get_db()
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS import_staging (
+                date TIMESTAMP, amount NUMERIC(14, 2), category TEXT, description TEXT, type TEXT
+            )
+        """)
+        lote = []
+        ultimo_aviso = time.monotonic()
+        for linha in linhas:
+            resumo['lidas'] += 1
+            if linha['date'] is None or not linha['amount']:
+                resumo['ignoradas'] += 1
+                continue
+            valor = -linha['amount'] if inverter_sinal else linha['amount']
+            tipo = 'expense' if valor < 0 else 'income'
+            descricao = linha['description'] or ('Gasto importado' if tipo == 'expense' else 'Receita importada')
+            categoria = _categoria_extrato(cur, user_id, linha) if tipo == 'expense' else 'RECEITA'
+            lote.append((linha['date'], abs(valor), categoria, descricao[:255], tipo))
+            if len(lote) >= IMPORT_BATCH_SIZE:
+                inseridas = _flush_import(cur, user_id, lote)
+                conn.commit()
+                resumo['importadas'] += inseridas
+                resumo['duplicadas'] += len(lote) - inseridas
+                lote = []
+                if progresso and time.monotonic() - ultimo_aviso >= IMPORT_PROGRESS_EVERY:
+                    progresso(resumo)
+                    ultimo_aviso = time.monotonic()
+        if lote:
+            inseridas = _flush_import(cur, user_id, lote)
+            conn.commit()
+            resumo['importadas'] += inseridas
+            resumo['duplicadas'] += len(lote) - inseridas
+        cur.execute("DROP TABLE IF EXISTS import_staging")
+        conn.commit()
+        cur.close()
+    finally:
+        release_db(conn)
+    name_resolver.invalidate(user_id)
+    return resumo
+
+def _texto_resumo_import(resumo, final=False):
+    titulo = "✅ **Importação concluída!**" if final else "⏳ **Importando extrato...**"
+    return (f"{titulo}\n\n📄 Linhas lidas: {resumo['lidas']}\n💾 Importadas: {resumo['importadas']}\n"
+            f"♻️ Já existiam: {resumo['duplicadas']}\n⚠️ Ignoradas: {resumo['ignoradas']}")
+
+def detect_card_statement(amostra, info, nome_arquivo, legenda):
+    """Decide se o sinal dos valores deve ser invertido (fatura de cartão com compras positivas).
+
+    Fatura é reconhecida pelo próprio arquivo (OFX de cartão, nome ou cabeçalho com
+    "fatura"/"cartão") ou pela legenda; nela, o sinal da maioria das linhas vira gasto.
+    Sem nenhum desses sinais, um extrato só com valores positivos também é tratado como
+    fatura, porque um extrato de conta sempre traz os débitos negativos.
+    """
+    valores = [linha['amount'] for linha in amostra if linha['amount']]
+    positivos = sum(1 for v in valores if v > 0)
+    texto = normalize_text(f"{legenda} {nome_arquivo} {info.get('cabecalho', '')}")
+    if info.get('cartao') or RE_FATURA_CARTAO.search(texto):
+        return positivos > len(valores) / 2
+    return bool(valores) and positivos == len(valores)
+
+def run_statement_import(chat_id, user_id, file_path, nome_arquivo, legenda):
+    aviso = bot.send_message(chat_id, "⏳ **Importando extrato...**", parse_mode="Markdown")
+
+    def progresso(resumo):
+        try:
+            bot.edit_message_text(_texto_resumo_import(resumo), chat_id, aviso.message_id, parse_mode="Markdown")
+        except Exception as e:
+            print(f"Erro ao atualizar progresso da importação: {e}", flush=True)
+
+    try:
+        with import_semaphore:
+            textos = _iter_text(_iter_download(file_path))
+            info = {}
+            if nome_arquivo.lower().endswith('.ofx'):
+                linhas = (_ofx_para_linha(trn) for trn in iter_ofx_rows(textos, info))
+            else:
+                linhas = iter_csv_rows(_iter_lines(textos), info)
+            # As primeiras linhas decidem o sinal e depois voltam para a frente do fluxo
+            amostra = list(itertools.islice(linhas, IMPORT_SIGN_SAMPLE))
+            inverter = detect_card_statement(amostra, info, nome_arquivo, legenda)
+            resumo = import_statement(user_id, itertools.chain(amostra, linhas), inverter_sinal=inverter, progresso=progresso)
+        texto_final = _texto_resumo_import(resumo, final=True)
+        if inverter:
+            texto_final += "\n\n💳 Li o arquivo como fatura de cartão: valores positivos entraram como gastos."
+        bot.edit_message_text(texto_final, chat_id, aviso.message_id, parse_mode="Markdown")
+    except ValueError as e:
+        bot.edit_message_text(f"❌ {e}", chat_id, aviso.message_id)
+    except Exception:
+        print(f"Erro na importação: {traceback.format_exc()}", flush=True)
+        bot.edit_message_text("❌ Não consegui importar esse extrato. Confira se é um CSV ou OFX válido.", chat_id, aviso.message_id)
+
+# --- LEMBRETES DE CONTAS A VENCER ---
+# Uma única consulta busca as contas e parcelas de todos os usuários; cada chat recebe
+# um resumo só. Antes de enviar, as contas do resumo são registradas em bill_reminders
+# e confirmadas: se o job cair ou rodar de novo, ninguém recebe o mesmo lembrete duas vezes.
+REMINDERS_LOCK_ID = 7317002
+
+class RateLimitedSender:
+    """Envia mensagens respeitando o limite global do bot e o intervalo mínimo por chat.
+
+    Os envios saem todos da mesma thread, então o telebot reaproveita a mesma sessão HTTP
+    (e a conexão keep-alive com a API). Em 429 espera o retry_after informado e tenta de novo.
+    """
+
+    def __init__(self, rate, chat_interval, max_retries):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.chat_interval = chat_interval
+        self.max_retries = max_retries
+        self._proximo = 0.0
+        self._ultimo_por_chat = {}
+
+    def _esperar(self, chat_id):
+        agora = time.monotonic()
+        liberado = max(self._proximo, self._ultimo_por_chat.get(chat_id, float('-inf')) + self.chat_interval)
+        if liberado > agora:
+            time.sleep(liberado - agora)
+            agora = liberado
+        self._proximo = agora + self.interval
+        self._ultimo_por_chat[chat_id] = agora
+
+    def send(self, chat_id, texto):
+        tentativa = 0
+        while True:
+            self._esperar(chat_id)
+            try:
+                return bot.send_message(chat_id, texto)
+            except telebot.apihelper.ApiTelegramException as e:
+                if e.error_code != 429 or tentativa >= self.max_retries:
+                    raise
+                metrics.inc('zap_telegram_throttled_total')
+                espera = ((e.result_json or {}).get('parameters') or {}).get('retry_after', 1)
+                # Um 429 vale para o bot inteiro: segura todos os envios seguintes
+                self._proximo = time.monotonic() + espera
+                tentativa += 1
+
+def _texto_lembrete(itens, hoje):
+    linhas = ["🔔 Lembrete: contas vencendo nos próximos dias\n"]
+    total = 0.0
+    for source, _, desc, amount, due_date, card in itens:
+        dias = (due_date - hoje).days
+        quando = "hoje" if dias <= 0 else ("amanhã" if dias == 1 else f"em {dias} dias")
+        nome = f"[{card}] {desc}" if card else desc
+        linhas.append(f"• {nome}: R$ {float(amount):.2f} (vence {quando}, {due_date:%d/%m})".replace('.', ','))
+        total += float(amount)
+    linhas.append(f"\n💸 Total: R$ {total:.2f}".replace('.', ','))
+    return "\n".join(linhas)
+
+def _buscar_contas_a_vencer(cur, inicio, fim):
+    cur.execute("""
+        WITH due AS (
+            SELECT 'bill' AS source, id, user_id, description, amount, due_date, NULL::text AS card
+            FROM unpaid_bills WHERE is_paid = false AND due_date >= %(inicio)s AND due_date < %(fim)s
+            UNION ALL
+            SELECT 'card', id, user_id, description, amount, due_date, card_name
+            FROM scheduled_expenses WHERE is_active = true AND due_date >= %(inicio)s AND due_date < %(fim)s
+        )
+        SELECT u.telegram_chat_id, d.source, d.id, d.description, d.amount, d.due_date, d.card
+        FROM due d
+        JOIN users u ON u.id = d.user_id
+        WHERE u.telegram_chat_id IS NOT NULL
+          AND NOT EXISTS (
+              SELECT 1 FROM bill_reminders r
+              WHERE r.source = d.source AND r.bill_id = d.id AND r.due_date = d.due_date
+          )
+        ORDER BY u.telegram_chat_id, d.due_date, d.id
+    """, {'inicio': inicio, 'fim': fim})
+    por_chat = OrderedDict()
+    for chat_id, *item in cur.fetchall():
+        por_chat.setdefault(chat_id, []).append(tuple(item))
+    return por_chat
+
+def send_bill_reminders(dias=REMINDER_DAYS_AHEAD, sender=None):
+    hoje = (datetime.utcnow() - timedelta(hours=3)).date()
+    sender = sender or RateLimitedSender(REMINDER_GLOBAL_RATE, REMINDER_CHAT_INTERVAL, REMINDER_MAX_RETRIES)
+    resumo = {'chats': 0, 'bills': 0, 'sent': 0, 'failed': 0, 'skipped': False}
+    conn = get_db()
+    cur = conn.cursor()
+    try:
+        # Lock de sessão: duas execuções do cron ao mesmo tempo não disputam os mesmos chats
+        cur.execute("SELECT pg_try_advisory_lock(%s)", (REMINDERS_LOCK_ID,))
+        if not cur.fetchone()[0]:
+            resumo['skipped'] = True
+            return resumo
+        try:
+            por_chat = _buscar_contas_a_vencer(cur, hoje, hoje + timedelta(days=dias + 1))
+            conn.commit()
+            resumo['chats'] = len(por_chat)
+            for chat_id, itens in por_chat.items():
+                chaves = [(source, bill_id, due_date, chat_id) for source, bill_id, _, _, due_date, _ in itens]
+                psycopg2.extras.execute_values(cur, """
+                    INSERT INTO bill_reminders (source, bill_id, due_date, chat_id) VALUES %s
+                    ON CONFLICT DO NOTHING
+                """, chaves)
+                conn.commit()
+                try:
+                    sender.send(chat_id, _texto_lembrete(itens, hoje))
+                except Exception as e:
+                    # Libera as contas para a próxima execução tentar de novo
+                    print(f"Erro ao enviar lembrete para {chat_id}: {e}", flush=True)
+                    cur.execute("""
+                        DELETE FROM bill_reminders WHERE chat_id = %s AND (source, bill_id, due_date) IN %s
+                    """, (chat_id, tuple((k[0], k[1], k[2]) for k in chaves)))
+                    conn.commit()
+                    resumo['failed'] += 1
+                    metrics.inc('zap_reminders_failed_total')
+                    continue
+                resumo['sent'] += 1
+                resumo['bills'] += len(itens)
+                metrics.inc('zap_reminders_sent_total')
+        finally:
+            conn.rollback()
+            cur.execute("SELECT pg_advisory_unlock(%s)", (REMINDERS_LOCK_ID,))
+            conn.commit()
+    finally:
+        cur.close()
+        release_db(conn)
+    return resumo
+
+_reminders_running = threading.Lock()
+
+def run_bill_reminders_job(dias):
+    try:
+        resumo = send_bill_reminders(dias)
+        print(f"Lembretes de contas: {json.dumps(resumo)}", flush=True)
+    except Exception:
+        print(f"Erro no job de lembretes: {traceback.format_exc()}", flush=True)
+    finally:
+        _reminders_running.release()
+
+# --- EXPORTAÇÃO DE EXTRATOS (CSV/XLSX) ---
+# Cada tabela é lida por um cursor nomeado (do lado do servidor) em lotes de
+# EXPORT_FETCH_SIZE linhas, e cada lote é escrito e entregue antes do próximo: a memória
+# usada não depende do tamanho do histórico. As três consultas rodam na mesma transação
+# REPEATABLE READ, então o arquivo é uma foto consistente dos dados.
+EXPORT_COLUNAS = ['Registro', 'Data', 'Descrição', 'Categoria/Cartão', 'Situação', 'Valor']
+
+EXPORT_CONSULTAS = [
+    ('Transações', """
+        SELECT date, description, category,
+               CASE type WHEN 'income' THEN 'Receita' WHEN 'expense' THEN 'Gasto' ELSE type END, amount
+        FROM transactions WHERE user_id = %(user_id)s AND date >= %(inicio)s AND date < %(fim)s
+        ORDER BY date, id
+    """),
+    ('Contas', """
+        SELECT due_date, description, category, CASE WHEN is_paid THEN 'Paga' ELSE 'Pendente' END, amount
+        FROM unpaid_bills WHERE user_id = %(user_id)s AND due_date >= %(inicio)s AND due_date < %(fim)s
+        ORDER BY due_date, id
+    """),
+    ('Cartões', """
+        SELECT due_date, description, card_name, CASE WHEN is_active THEN 'Pendente' ELSE 'Inativa' END, amount
+        FROM scheduled_expenses WHERE user_id = %(user_id)s AND due_date >= %(inicio)s AND due_date < %(fim)s
+        ORDER BY due_date, id
+    """),
+]
+
+# Sem período informado a exportação cobre todo o histórico
+EXPORT_INICIO_PADRAO = datetime(1970, 1, 1)
+EXPORT_FIM_PADRAO = datetime(9999, 1, 1)
+
+EXPORT_FORMATOS = {
+    'csv': 'text/csv; charset=utf-8',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+RE_XML_INVALIDO = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+export_semaphore = threading.BoundedSemaphore(max(1, EXPORT_MAX_CONCURRENT))
+
+def _formatar_data_export(valor):
+    if isinstance(valor, datetime):
+        return valor.strftime('%d/%m/%Y %H:%M')
+    if isinstance(valor, date):
+        return valor.strftime('%d/%m/%Y')
+    return ''
+
+class _ChunkBuffer:
+    """Destino de escrita que só acumula os bytes até o próximo drain()."""
+
+    def __init__(self):
+        self.partes = []
+
+    def write(self, dados):
+        self.partes.append(bytes(dados))
+        return len(dados)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        dados = b''.join(self.partes)
+        self.partes = []
+        return dados
+
+class CsvExportWriter:
+    # Separador ';' e vírgula decimal, como o Excel em português espera
+    def __init__(self):
+        self._texto = io.StringIO()
+        self._csv = csv.writer(self._texto, delimiter=';')
+        self._texto.write('\ufeff')
+        self._csv.writerow(EXPORT_COLUNAS)
+
+    def begin_sheet(self, nome):
+        self._registro = nome
+
+    def write_rows(self, rows):
+        for data, desc, categoria, situacao, valor in rows:
+            self._csv.writerow([self._registro, _formatar_data_export(data), desc or '', categoria or '',
+                                situacao or '', f"{valor:.2f}".replace('.', ',') if valor is not None else ''])
+
+    def end_sheet(self):
+        pass
+
+    def close(self):
+        pass
+
+    def drain(self):
+        dados = self._texto.getvalue().encode('utf-8')
+        self._texto.seek(0)
+        self._texto.truncate(0)
+        return dados
+
+class XlsxExportWriter:
+    """Planilha .xlsx mínima (uma aba por tabela) escrita direto no zip, sem biblioteca externa.
+
+    O zip é gravado em modo streaming (com data descriptors), então cada aba vai saindo
+    comprimida à medida que as linhas chegam.
+    """
+
+    def __init__(self):
+        self._buffer = _ChunkBuffer()
+        self._zip = zipfile.ZipFile(self._buffer, 'w', zipfile.ZIP_DEFLATED)
+        self._abas = []
+        self._aba = None
+
+    @staticmethod
+    def _celula(ref, valor):
+        if isinstance(valor, (int, float)) or hasattr(valor, 'as_tuple'):
+            return f'<c r="{ref}"><v>{valor}</v></c>'
+        if isinstance(valor, date):
+            valor = _formatar_data_export(valor)
+        texto = xml_escape(RE_XML_INVALIDO.sub('', str(valor or '')))
+        return f'<c r="{ref}" t="inlineStr"><is><t xml:space="preserve">{texto}</t></is></c>'
+
+    def _linha(self, valores):
+        self._linhas += 1
+        celulas = ''.join(self._celula(f"{chr(65 + i)}{self._linhas}", v) for i, v in enumerate(valores))
+        return f'<row r="{self._linhas}">{celulas}</row>'
+
+    def begin_sheet(self, nome):
+        self._abas.append(nome)
+        self._linhas = 0
+        self._aba = self._zip.open(f"xl/worksheets/sheet{len(self._abas)}.xml", 'w')
+        self._aba.write(('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                         '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+                         + self._linha(EXPORT_COLUNAS[1:])).encode('utf-8'))
+
+    def write_rows(self, rows):
+        self._aba.write(''.join(self._linha(r) for r in rows).encode('utf-8'))
+
+    def end_sheet(self):
+        self._aba.write(b'</sheetData></worksheet>')
+        self._aba.close()
+        self._aba = None
+
+    def close(self):
+        abas = list(enumerate(self._abas, 1))
+        self._zip.writestr('[Content_Types].xml', (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            + ''.join(f'<Override PartName="/xl/worksheets/sheet{i}.xml" '
+                      'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>' for i, _ in abas)
+            + '</Types>'))
+        self._zip.writestr('_rels/.rels', (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+            '</Relationships>'))
+        self._zip.writestr('xl/workbook.xml', (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships"><sheets>'
+            + ''.join(f'<sheet name="{xml_escape(nome)}" sheetId="{i}" r:id="rId{i}"/>' for i, nome in abas)
+            + '</sheets></workbook>'))
+        self._zip.writestr('xl/_rels/workbook.xml.rels', (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            + ''.join(f'<Relationship Id="rId{i}" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+                      f'Target="worksheets/sheet{i}.xml"/>' for i, _ in abas)
+            + '</Relationships>'))
+        self._zip.close()
+
+    def drain(self):
+        return self._buffer.drain()
+
+EXPORT_WRITERS = {'csv': CsvExportWriter, 'xlsx': XlsxExportWriter}
+
+def stream_export(user_id, inicio, fim, formato):
+    """Gera o arquivo de exportação em pedaços de bytes, um por lote lido do banco."""
+    writer = EXPORT_WRITERS[formato]()
+    params = {'user_id': user_id, 'inicio': inicio or EXPORT_INICIO_PADRAO, 'fim': fim or EXPORT_FIM_PADRAO}
+    conn = get_db()
+    try:
+        conn.rollback()
+        with conn.cursor() as cur:
+            cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+        for i, (nome, sql) in enumerate(EXPORT_CONSULTAS):
+            writer.begin_sheet(nome)
+            # Cursor nomeado: o Postgres guarda o resultado e entrega só o lote pedido
+            cur = conn.cursor(name=f"export_{user_id}_{i}")
+            try:
+                cur.execute(sql, params)
+                while True:
+                    rows = cur.fetchmany(EXPORT_FETCH_SIZE)
+                    if not rows:
+                        break
+                    writer.write_rows(rows)
+                    yield writer.drain()
+            finally:
+                cur.close()
+            writer.end_sheet()
+        writer.close()
+        yield writer.drain()
+    finally:
+        conn.rollback()
+        release_db(conn)
+
+def make_export_token(user_id, ttl=EXPORT_LINK_TTL):
+    expira = int(time.time() + ttl)
+    assinatura = hmac.new(EXPORT_SECRET.encode(), f"{user_id}:{expira}".encode(), hashlib.sha256).hexdigest()
+    return f"{user_id}.{expira}.{assinatura}"
+
+def check_export_token(token):
+    """Retorna o user_id do link assinado, ou None se for inválido ou estiver vencido."""
+    try:
+        user_id, expira, assinatura = (token or '').split('.')
+        user_id, expira = int(user_id), int(expira)
+    except ValueError:
+        return None
+    if not EXPORT_SECRET or expira < time.time():
+        return None
+    esperado = hmac.new(EXPORT_SECRET.encode(), f"{user_id}:{expira}".encode(), hashlib.sha256).hexdigest()
+    return user_id if hmac.compare_digest(esperado, assinatura) else None
+
+def export_link(user_id, inicio, fim, formato):
+    if not EXPORT_BASE_URL or not EXPORT_SECRET:
+        return None
+    url = f"{EXPORT_BASE_URL}/export?token={make_export_token(user_id)}&format={formato}"
+    if inicio:
+        # Na URL o fim é inclusivo
+        url += f"&start={inicio:%Y-%m-%d}&end={fim - timedelta(days=1):%Y-%m-%d}"
+    return url
+
+def run_export(chat_id, user_id, inicio, fim, formato, rotulo):
+    nome_arquivo = f"zapfinanceiro_{rotulo.replace('/', '-').replace(' ', '_').lower()}.{formato}"
+    try:
+        with export_semaphore, tempfile.TemporaryFile() as arquivo:
+            tamanho = 0
+            for pedaco in stream_export(user_id, inicio, fim, formato):
+                tamanho += len(pedaco)
+                if tamanho > EXPORT_DOCUMENT_MAX:
+                    break
+                arquivo.write(pedaco)
+            if tamanho > EXPORT_DOCUMENT_MAX:
+                link = export_link(user_id, inicio, fim, formato)
+                if link:
+                    bot.send_message(chat_id, f"📦 O arquivo ficou grande demais para o Telegram. Baixe por aqui (válido por {int(EXPORT_LINK_TTL // 60)} min):\n{link}")
+                else:
+                    bot.send_message(chat_id, "📦 O arquivo ficou grande demais para o Telegram. Peça a exportação de um mês por vez.")
+                return
+            arquivo.seek(0)
+            bot.send_document(chat_id, arquivo, visible_file_name=nome_arquivo, caption=f"📦 Exportação ({rotulo})")
+    except Exception:
+        print(f"Erro na exportação: {traceback.format_exc()}", flush=True)
+        bot.send_message(chat_id, "❌ Não consegui gerar a exportação agora. Tente novamente mais tarde.")
+
+# --- FILA DE UPDATES DO WEBHOOK ---
+# Cada chat sempre cai na mesma thread, então as mensagens de um usuário são
+# processadas em ordem enquanto chats diferentes rodam em paralelo.
+# A ordem por chat vale dentro de um worker do gunicorn: com vários workers, duas
+# mensagens do mesmo chat entregues a workers diferentes podem rodar ao mesmo tempo.
+# Já a deduplicação por update_id é feita no Postgres e vale para todos os workers.
+_claims = 0
+_claims_lock = threading.Lock()
+
+def claim_update(update_id):
+    """Registra o update_id em processed_updates.
+
+    False se outro worker já o recebeu; None se não deu para registrar (sem banco).
+    """
+    global _claims
+    if update_id < 0:
+        # Mensagens adiadas reenviadas pelo DeferredDrainer já foram registradas
+        return True
+    with _claims_lock:
+        _claims += 1
+        limpar = _claims % 500 == 0
+    conn = None
+    try:
+        # Espera curta: o webhook ainda não respondeu ao Telegram
+        conn = get_db(WEBHOOK_CLAIM_TIMEOUT)
+        cur = conn.cursor()
+        cur.execute("INSERT INTO processed_updates (update_id) VALUES (%s) ON CONFLICT DO NOTHING", (update_id,))
+        novo = cur.rowcount == 1
+        if limpar:
+            cur.execute("DELETE FROM processed_updates WHERE received_at < now() - %s * INTERVAL '1 second'", (WEBHOOK_DEDUP_TTL,))
+        conn.commit()
+        cur.close()
+        return novo
+    except Exception as e:
+        # Pool esgotado ou banco fora: o Telegram reenvia o update depois
+        print(f"Erro ao registrar update {update_id}: {e}", flush=True)
+        return None
+    finally:
+        if conn is not None:
+            release_db(conn)
+
+def release_update(update_id):
+    # Update recusado (fila cheia): o Telegram vai reenviar e ele precisa ser aceito
+    conn = None
+    try:
+        conn = get_db(WEBHOOK_CLAIM_TIMEOUT)
+        cur = conn.cursor()
+        cur.execute("DELETE FROM processed_updates WHERE update_id = %s", (update_id,))
+        conn.commit()
+        cur.close()
+    except Exception as e:
+        print(f"Erro ao liberar update {update_id}: {e}", flush=True)
+    finally:
+        if conn is not None:
+            release_db(conn)
+
+class UpdateDispatcher:
+    def __init__(self, workers, queue_size, enqueue_timeout, dedup_size):
+        self.workers = max(1, workers)
+        self.queue_size = queue_size
+        self.enqueue_timeout = enqueue_timeout
+        self.dedup_size = dedup_size
+        self.pid = None
+        self._lock = threading.Lock()
+        self._queues = []
+        self._threads = []
+        self._seen = OrderedDict()
+        self._stats = {'enqueued': 0, 'processed': 0, 'duplicates': 0, 'rejected': 0, 'errors': 0}
+
+    def _start(self):
+        # Inicia as threads no próprio worker do gunicorn (threads não sobrevivem ao fork)
+        if self.pid == os.getpid():
+            return
+        with self._lock:
+            if self.pid == os.getpid():
+                return
+            self._seen = OrderedDict()
+            self._queues = [queue.Queue(maxsize=self.queue_size) for _ in range(self.workers)]
+            self._threads = []
+            for i, q in enumerate(self._queues):
+                t = threading.Thread(target=self._run, args=(q,), name=f"update-worker-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+            self.pid = os.getpid()
+
+    def _run(self, q):
+        while True:
+            update = q.get()
+            if update is None:
+                q.task_done()
+                return
+            try:
+                bot.process_new_updates([update])
+                with self._lock:
+                    self._stats['processed'] += 1
+            except Exception:
+                with self._lock:
+                    self._stats['errors'] += 1
+                print(f"Erro no worker de updates: {traceback.format_exc()}", flush=True)
+            finally:
+                q.task_done()
+
+    def _chat_key(self, update):
+        for msg in (update.message, update.edited_message):
+            if msg is not None:
+                return msg.chat.id
+        return update.update_id
+
+    def submit(self, update):
+        """Retorna 'queued', 'duplicate', 'full' ou 'unavailable'."""
+        self._start()
+        with self._lock:
+            if update.update_id in self._seen:
+                self._stats['duplicates'] += 1
+                return 'duplicate'
+            self._seen[update.update_id] = True
+            while len(self._seen) > self.dedup_size:
+                self._seen.popitem(last=False)
+        # O OrderedDict evita a ida ao banco nos reenvios que caem no mesmo worker
+        novo = claim_update(update.update_id)
+        if novo is None:
+            # Não deu para registrar: esquece o update_id para o reenvio do Telegram ser aceito
+            with self._lock:
+                self._seen.pop(update.update_id, None)
+                self._stats['rejected'] += 1
+            return 'unavailable'
+        if not novo:
+            with self._lock:
+                self._stats['duplicates'] += 1
+            return 'duplicate'
+        q = self._queues[hash(self._chat_key(update)) % self.workers]
+        try:
+            q.put(update, timeout=self.enqueue_timeout)
+        except queue.Full:
+            # Sem espaço: libera o update_id para o Telegram poder reenviar depois
+            with self._lock:
+                self._seen.pop(update.update_id, None)
+                self._stats['rejected'] += 1
+            release_update(update.update_id)
+            return 'full'
+        with self._lock:
+            self._stats['enqueued'] += 1
+        return 'queued'
+
+    def join(self):
+        for q in list(self._queues):
+            q.join()
+
+    def stop(self, timeout=10):
+        if self.pid != os.getpid():
+            return
+        for q in self._queues:
+            try:
+                q.put(None, timeout=timeout)
+            except queue.Full:
+                pass
+        for t in self._threads:
+            t.join(timeout)
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+        s['workers'] = self.workers
+        s['queued'] = sum(q.qsize() for q in self._queues) if self.pid == os.getpid() else 0
+        s['queue_capacity'] = self.workers * self.queue_size
+        return s
+
+dispatcher = UpdateDispatcher(WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE, WEBHOOK_ENQUEUE_TIMEOUT, WEBHOOK_DEDUP_SIZE)
+atexit.register(dispatcher.stop)
+
 @app.route('/')
 def index():
     return "ZapFinanceiro Online!", 200
 
+def collect_stats():
+    conn = get_db()
+    try:
+        cur = conn.cursor()
+        pendentes = pending_user_actions.stats(cur)
+        cur.close()
+    finally:
+        release_db(conn)
+    return {
+        'db_pool': get_pool().stats(), 'parser': get_parser_stats(), 'ai_cache': ai_cache.stats(),
+        'updates': dispatcher.stats(), 'resolver': name_resolver.stats(),
+        'pending_actions': pendentes, 'ai_breaker': ai_breaker.stats(), 'deferred': deferred_drainer.stats(),
+    }
+
+@app.route('/stats')
+def stats_route():
+    return collect_stats(), 200
+
+@app.route('/metrics')
+def metrics_route():
+    # As estatísticas numéricas de /stats viram gauges (ex.: zap_db_pool_in_use)
+    gauges = {}
+    try:
+        for componente, valores in collect_stats().items():
+            for chave, valor in valores.items():
+                if isinstance(valor, (int, float)) and not isinstance(valor, bool):
+                    gauges[f"zap_{componente}_{chave}"] = valor
+    except Exception as e:
+        print(f"Erro ao coletar estatísticas para /metrics: {e}", flush=True)
+    return metrics.render(gauges), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
 @app.route('/set_webhook')
 def set_webhook_route():
     base_url = request.url_root.replace("http://", "https://")
@@ -81,25 +2475,76 @@ def set_webhook_route():
     bot.set_webhook(url=webhook_url)
     return f"✅ Conexão com o Telegram resetada com sucesso para: {webhook_url}", 200
 
+@app.route('/jobs/bill_reminders', methods=['POST'])
+def bill_reminders_route():
+    if not REMINDER_JOB_TOKEN or request.headers.get('X-Job-Token') != REMINDER_JOB_TOKEN:
+        return 'Não autorizado', 403
+    dias = request.args.get('days', REMINDER_DAYS_AHEAD, type=int)
+    if not _reminders_running.acquire(blocking=False):
+        return 'Job de lembretes já em andamento', 409
+    # O envio respeita o limite do Telegram e pode demorar: roda fora da requisição do cron
+    threading.Thread(target=run_bill_reminders_job, args=(dias,), name="bill-reminders", daemon=True).start()
+    return 'Job de lembretes iniciado', 202
+
+def _parse_export_date(texto):
+    return datetime.strptime(texto, '%Y-%m-%d') if texto else None
+
+@app.route('/export')
+def export_route():
+    token = request.args.get('token') or request.headers.get('Authorization', '').replace('Bearer ', '', 1).strip()
+    user_id = check_export_token(token)
+    if user_id is None:
+        return 'Não autorizado', 403
+    formato = request.args.get('format', 'csv').lower()
+    if formato not in EXPORT_FORMATOS:
+        return 'Formato inválido (use csv ou xlsx)', 400
+    try:
+        inicio = _parse_export_date(request.args.get('start'))
+        fim = _parse_export_date(request.args.get('end'))
+    except ValueError:
+        return 'Datas no formato AAAA-MM-DD', 400
+    fim = fim + timedelta(days=1) if fim else None
+    if not export_semaphore.acquire(blocking=False):
+        return 'Muitas exportações em andamento, tente de novo em instantes', 429
+    # Sem Content-Length: o Flask/WSGI envia a resposta em chunks conforme o gerador produz
+    resposta = Response(stream_export(user_id, inicio, fim, formato), mimetype=EXPORT_FORMATOS[formato],
+                        headers={'Content-Disposition': f'attachment; filename="zapfinanceiro.{formato}"'})
+    resposta.call_on_close(export_semaphore.release)
+    return resposta
+
 @app.route(f'/{TOKEN}', methods=['POST'])
 def webhook():
     json_string = request.get_data().decode('utf-8')
     update = telebot.types.Update.de_json(json_string)
-    bot.process_new_updates([update])
+    deferred_drainer.ensure_started()
+    if not WEBHOOK_ASYNC:
+        if claim_update(update.update_id):
+            bot.process_new_updates([update])
+        return '', 200
+    status = dispatcher.submit(update)
+    if status == 'full':
+        # Fila cheia: o Telegram tenta de novo mais tarde
+        return 'Fila cheia', 503
+    if status == 'unavailable':
+        return 'Banco indisponível', 503
     return '', 200
 
 @bot.message_handler(func=lambda message: True)
 def handle_message(message):
-    global pending_user_actions
     chat_id = message.chat.id
     text = message.text or ""
     conn = None
+    action = None
+    start_trace()
+    start_deadline()
 
     try:
-        conn = get_db()
+        with stage('db_connect'):
+            conn = get_db()
         cur = conn.cursor()
-        cur.execute("SELECT id, name FROM users WHERE telegram_chat_id = %s", (int(chat_id),))
-        user = cur.fetchone()
+        with stage('user_lookup'):
+            cur.execute("SELECT id, name FROM users WHERE telegram_chat_id = %s", (int(chat_id),))
+            user = cur.fetchone()
         
         # Como limpamos a tabela users com TRUNCATE, se seu user_id=1 sumiu do bot, nós auto-cadastramos para você não travar
         if not user:
@@ -109,8 +2554,25 @@ def handle_message(message):
         else:
             user_id = user[0]
         
-        data = process_with_ai(text)
+        pendente = pending_user_actions.get(cur, user_id)
+        try:
+            with stage('ai'):
+                data = interpret_message(text, pending=pendente is not None, cur=cur, user_id=user_id)
+        except AIUnavailable as e:
+            if pendente is None:
+                # Modo degradado: nada de "Como posso ajudar?"; a mensagem volta quando a IA responder
+                action = 'deferred'
+                reenvio = is_replayed(message)
+                defer_message(cur, message)
+                if reenvio:
+                    return
+                bot.reply_to(message, "⏳ Minha inteligência está instável agora. Guardei sua mensagem e vou registrá-la assim que voltar ao normal!")
+                return
+            # Com uma ação pendente o texto ainda serve como resposta (ex.: o nome do banco)
+            data = None
         action = data.get('action') if data else 'chat'
+        if data is None:
+            metrics.inc('zap_ai_fallback_chat_total')
 
         # --- BLINDAGEM CONTRA VALORES VAZIOS E PADRONIZAÇÃO MAIÚSCULA ---
         if data:
@@ -124,39 +2586,18 @@ def handle_message(message):
                 if data.get(key):
                     data[key] = data[key].upper()
 
-        if user_id in pending_user_actions:
-            if action == 'provide_bank' or action == 'chat':
+        if pendente is not None:
+            # pop pode voltar None se outro worker já consumiu ou se a ação expirou
+            pending_data = pending_user_actions.pop(cur, user_id)
+            if pending_data and (action == 'provide_bank' or action == 'chat'):
                 banco_informado = data.get('bank') if (action == 'provide_bank' and data.get('bank')) else text.strip()
-                pending_data = pending_user_actions.pop(user_id)
-                pending_data['bank'] = banco_informado.upper()
+                pending_data[pending_data.pop('_pending_field', 'bank')] = banco_informado.upper()
                 data = pending_data
                 action = data.get('action')
-            else:
-                pending_user_actions.pop(user_id, None)
         
         hoje = datetime.utcnow() - timedelta(hours=3)
         bahia_now = "(CURRENT_TIMESTAMP AT TIME ZONE 'UTC' - INTERVAL '3 hours')"
 
-        meses_pt = {1: 'Janeiro', 2: 'Fevereiro', 3: 'Março', 4: 'Abril', 5: 'Maio', 6: 'Junho', 
-                    7: 'Julho', 8: 'Agosto', 9: 'Setembro', 10: 'Outubro', 11: 'Novembro', 12: 'Dezembro'}
-        
-        meses_num = {v.lower(): k for k, v in meses_pt.items()}
-
-        if data and data.get('month'):
-            mes_original = str(data['month']).lower()
-            traducao_meses = {
-                'january': 'Janeiro', 'february': 'Fevereiro', 'march': 'Março', 'april': 'Abril',
-                'may': 'Maio', 'june': 'Junho', 'july': 'Julho', 'august': 'Agosto',
-                'september': 'Setembro', 'october': 'Outubro', 'november': 'Novembro', 'december': 'Dezembro',
-                'jan': 'Janeiro', 'feb': 'Fevereiro', 'mar': 'Março', 'apr': 'Abril',
-                'jun': 'Junho', 'jul': 'Julho', 'aug': 'Agosto', 'sep': 'Setembro',
-                'oct': 'Outubro', 'nov': 'Novembro', 'dec': 'Dezembro'
-            }
-            if mes_original in traducao_meses:
-                data['month'] = traducao_meses[mes_original]
-            else:
-                data['month'] = mes_original.capitalize()
-
         # --- GESTÃO DE BANCOS ---
         if action == 'create_bank':
             banco = data.get('bank')
@@ -169,19 +2610,33 @@ def handle_message(message):
         elif action == 'update_bank':
             old_bank = data.get('old_bank')
             new_bank = data.get('new_bank')
-            cur.execute("UPDATE accounts SET bank_name = %s WHERE user_id = %s AND bank_name ILIKE %s", (new_bank, user_id, f"%{old_bank}%"))
-            if cur.rowcount > 0:
+
+            def renomear(conta):
+                cur.execute("UPDATE accounts SET bank_name = %s WHERE id = %s", (new_bank, conta[0]))
+                return cur.rowcount > 0
+
+            status, conta = name_resolver.apply(cur, user_id, 'bank', old_bank, renomear, strict=True)
+            if status in ('ambiguous', 'confirm'):
+                ask_to_pick(message, cur, user_id, data, 'old_bank', 'banco', conta)
+            elif status == 'ok':
                 conn.commit()
-                bot.reply_to(message, f"✏️ O banco **{old_bank}** foi alterado para **{new_bank}** com sucesso!", parse_mode="Markdown")
+                bot.reply_to(message, f"✏️ O banco **{conta[1]}** foi alterado para **{new_bank}** com sucesso!", parse_mode="Markdown")
             else:
                 bot.reply_to(message, f"❌ Não encontrei o banco **{old_bank}** para alterar.", parse_mode="Markdown")
 
         elif action == 'delete_bank':
             banco = data.get('bank', '')
-            cur.execute("DELETE FROM accounts WHERE user_id = %s AND bank_name ILIKE %s", (user_id, f"%{banco}%"))
-            if cur.rowcount > 0:
+
+            def apagar(conta):
+                cur.execute("DELETE FROM accounts WHERE id = %s", (conta[0],))
+                return cur.rowcount > 0
+
+            status, conta = name_resolver.apply(cur, user_id, 'bank', banco, apagar, strict=True)
+            if status in ('ambiguous', 'confirm'):
+                ask_to_pick(message, cur, user_id, data, 'bank', 'banco', conta)
+            elif status == 'ok':
                 conn.commit()
-                bot.reply_to(message, f"🏦 A conta do banco **{banco}** foi apagada com sucesso!", parse_mode="Markdown")
+                bot.reply_to(message, f"🏦 A conta do banco **{conta[1]}** foi apagada com sucesso!", parse_mode="Markdown")
             else:
                 bot.reply_to(message, f"❌ Não encontrei nenhum banco com o nome **{banco}** para apagar.", parse_mode="Markdown")
 
@@ -195,46 +2650,82 @@ def handle_message(message):
         elif action == 'update_category':
             old_cat = data.get('old_category')
             new_cat = data.get('new_category')
-            cur.execute("UPDATE transactions SET category = %s WHERE user_id = %s AND category ILIKE %s", (new_cat, user_id, f"%{old_cat}%"))
-            trans_count = cur.rowcount
-            cur.execute("UPDATE categories SET name = %s WHERE user_id = %s AND name ILIKE %s", (new_cat, user_id, f"%{old_cat}%"))
-            conn.commit()
-            if trans_count > 0 or cur.rowcount > 0:
-                bot.reply_to(message, f"✏️ Categoria **{old_cat}** alterada para **{new_cat}** com sucesso!", parse_mode="Markdown")
+
+            def renomear(categoria):
+                cat_id, cat_nome = categoria
+                cur.execute("UPDATE transactions SET category = %s WHERE user_id = %s AND upper(category) = upper(%s)", (new_cat, user_id, cat_nome))
+                alterou = cur.rowcount > 0
+                if cat_id is not None:
+                    cur.execute("UPDATE categories SET name = %s WHERE id = %s", (new_cat, cat_id))
+                    alterou = alterou or cur.rowcount > 0
+                return alterou
+
+            status, categoria = name_resolver.apply(cur, user_id, 'category', old_cat, renomear, strict=True)
+            if status in ('ambiguous', 'confirm'):
+                ask_to_pick(message, cur, user_id, data, 'old_category', 'categoria', categoria)
+            elif status == 'ok':
+                cat_nome = categoria[1]
+                conn.commit()
+                bot.reply_to(message, f"✏️ Categoria **{cat_nome}** alterada para **{new_cat}** com sucesso!", parse_mode="Markdown")
             else:
                 bot.reply_to(message, f"❌ Não encontrei a categoria **{old_cat}** para alterar.", parse_mode="Markdown")
 
         elif action == 'delete_category':
             cat = data.get('category')
-            cur.execute("UPDATE transactions SET category = 'GERAL' WHERE user_id = %s AND category ILIKE %s", (user_id, f"%{cat}%"))
-            cur.execute("DELETE FROM categories WHERE user_id = %s AND name ILIKE %s", (user_id, f"%{cat}%"))
-            conn.commit()
-            bot.reply_to(message, f"🗑️ Categoria **{cat}** deletada!\n⚠️ *Os gastos antigos foram movidos para a categoria 'GERAL'.*", parse_mode="Markdown")
+
+            def apagar(categoria):
+                cat_id, cat_nome = categoria
+                cur.execute("UPDATE transactions SET category = 'GERAL' WHERE user_id = %s AND upper(category) = upper(%s)", (user_id, cat_nome))
+                apagou = cur.rowcount > 0
+                if cat_id is not None:
+                    cur.execute("DELETE FROM categories WHERE id = %s", (cat_id,))
+                    apagou = apagou or cur.rowcount > 0
+                return apagou
+
+            status, categoria = name_resolver.apply(cur, user_id, 'category', cat, apagar, strict=True)
+            if status in ('ambiguous', 'confirm'):
+                ask_to_pick(message, cur, user_id, data, 'category', 'categoria', categoria)
+            elif status == 'ok':
+                cat_nome = categoria[1]
+                conn.commit()
+                bot.reply_to(message, f"🗑️ Categoria **{cat_nome}** deletada!\n⚠️ *Os gastos antigos foram movidos para a categoria 'GERAL'.*", parse_mode="Markdown")
+            else:
+                bot.reply_to(message, f"❌ Não encontrei a categoria **{cat}** para apagar.", parse_mode="Markdown")
 
         # --- FUNÇÃO: APAGAR ÚLTIMO GASTO ---
         elif action == 'delete_last':
-            cur.execute("SELECT id, amount, description FROM transactions WHERE user_id = %s ORDER BY id DESC LIMIT 1", (user_id,))
+            # Só gastos: receitas (do bot ou importadas) não entram no "apagar último gasto"
+            cur.execute("""
+                SELECT id, amount, description FROM transactions
+                WHERE user_id = %s AND COALESCE(type, 'expense') = 'expense'
+                ORDER BY id DESC LIMIT 1
+            """, (user_id,))
             last_tx = cur.fetchone()
             if last_tx:
                 tx_id, valor, desc = last_tx
+                # O estorno no ledger e a exclusão entram no mesmo commit
+                estornos = reverse_transaction(cur, user_id, tx_id)
                 cur.execute("DELETE FROM transactions WHERE id = %s", (tx_id,))
                 conn.commit()
-                bot.reply_to(message, f"🗑️ **Último gasto apagado com sucesso!**\n\n💸 Descrição: {desc}\n💰 Valor: R$ {valor:.2f}\n\n⚠️ *Dica: Se este gasto descontou saldo do banco, lembre-se de adicionar o valor de volta manualmente.*", parse_mode="Markdown")
+                mensagem = f"🗑️ **Último gasto apagado com sucesso!**\n\n💸 Descrição: {desc}\n💰 Valor: R$ {valor:.2f}\n\n"
+                if estornos:
+                    mensagem += "\n".join(f"🏦 Saldo do {banco} ajustado em R$ {float(v):+.2f}" for banco, v in estornos)
+                else:
+                    mensagem += "⚠️ *Este lançamento não estava ligado a nenhum banco, então nenhum saldo foi alterado.*"
+                bot.reply_to(message, mensagem, parse_mode="Markdown")
             else:
                 bot.reply_to(message, "Não encontrei nenhum gasto recente para apagar.")
 
         # --- FUNÇÃO CORRIGIDA: APAGAR CONTA/FATURA ---
         elif action == 'delete_bill':
             desc = data.get('description', '')
-            mes = data.get('month', '')
-            if not mes:
-                mes = meses_pt[hoje.month]
-            mes_alvo = meses_num.get(mes.lower(), hoje.month)
+            ano_alvo, mes_alvo, mes = resolve_month(data.get('month'), hoje)
+            inicio, fim = month_range(ano_alvo, mes_alvo)
             
             cur.execute("""
                 DELETE FROM unpaid_bills 
-                WHERE user_id = %s AND description ILIKE %s AND EXTRACT(MONTH FROM due_date) = %s
-            """, (user_id, f"%{desc}%", mes_alvo))
+                WHERE user_id = %s AND due_date >= %s AND due_date < %s AND description ILIKE %s
+            """, (user_id, inicio, fim, f"%{desc}%"))
             
             if cur.rowcount > 0:
                 conn.commit()
@@ -242,8 +2733,8 @@ def handle_message(message):
             else:
                 cur.execute("""
                     DELETE FROM scheduled_expenses 
-                    WHERE user_id = %s AND description ILIKE %s AND EXTRACT(MONTH FROM due_date) = %s
-                """, (user_id, f"%{desc}%", mes_alvo))
+                    WHERE user_id = %s AND due_date >= %s AND due_date < %s AND description ILIKE %s
+                """, (user_id, inicio, fim, f"%{desc}%"))
                 if cur.rowcount > 0:
                     conn.commit()
                     bot.reply_to(message, f"🗑️ A fatura/compra **'{desc}'** do mês de **{mes}** foi excluída!", parse_mode="Markdown")
@@ -260,20 +2751,21 @@ def handle_message(message):
             
             valor_parcela = total / parcelas
             
+            linhas = []
             for i in range(parcelas):
                 mes_futuro = hoje.month + i + 1
-                ano_futuro = ServerAno = hoje.year + (mes_futuro - 1) // 12
+                ano_futuro = hoje.year + (mes_futuro - 1) // 12
                 mes_num = (mes_futuro - 1) % 12 + 1
                 
                 vencimento = datetime(ano_futuro, mes_num, 10)
                 nova_desc = f"{desc_original} ({i+1}/{parcelas})"
-                
-                # Inserção correta na tabela scheduled_expenses recriada
-                cur.execute("""
-                    INSERT INTO scheduled_expenses (user_id, amount, description, is_active, card_name, due_date) 
-                    VALUES (%s, %s, %s, true, %s, %s)
-                """, (user_id, valor_parcela, nova_desc, cartao, vencimento))
+                linhas.append((user_id, valor_parcela, nova_desc, True, cartao, vencimento))
             
+            # Todas as parcelas em um único INSERT com várias linhas
+            psycopg2.extras.execute_values(cur, """
+                INSERT INTO scheduled_expenses (user_id, amount, description, is_active, card_name, due_date) 
+                VALUES %s
+            """, linhas, page_size=max(100, len(linhas)))
             conn.commit()
             if parcelas == 1:
                 bot.reply_to(message, f"💳 Compra à vista de R$ {total:.2f} no cartão {cartao} lançada com sucesso!", parse_mode="Markdown")
@@ -283,10 +2775,16 @@ def handle_message(message):
         # --- AÇÕES DE GASTOS, RECEITAS E METAS ---
         elif action == 'add_income':
             bank = data.get('bank', 'GERAL')
+            # O DO UPDATE sem efeito só serve para o RETURNING devolver o id da conta que já existe
             cur.execute("""
-                INSERT INTO accounts (user_id, bank_name, balance) VALUES (%s, %s, %s) 
-                ON CONFLICT (user_id, bank_name) DO UPDATE SET balance = accounts.balance + EXCLUDED.balance
-            """, (user_id, bank, data['amount']))
+                INSERT INTO accounts (user_id, bank_name, balance) VALUES (%s, %s, 0)
+                ON CONFLICT (user_id, bank_name) DO UPDATE SET bank_name = EXCLUDED.bank_name
+                RETURNING id
+            """, (user_id, bank))
+            conta_id = cur.fetchone()[0]
+            cur.execute("INSERT INTO transactions (user_id, amount, description, type) VALUES (%s, %s, %s, 'income') RETURNING id",
+                        (user_id, data['amount'], data.get('description') or 'Receita'))
+            ledger_post(cur, conta_id, user_id, data['amount'], 'income', cur.fetchone()[0])
             conn.commit()
             bot.reply_to(message, f"💰 R$ {data['amount']:.2f} adicionados ao {bank}!")
 
@@ -300,27 +2798,49 @@ def handle_message(message):
 
         elif action == 'add_expense':
             if not data.get('bank') or data.get('bank') == '':
-                pending_user_actions[user_id] = data
+                pending_user_actions.set(cur, user_id, data)
                 bot.reply_to(message, "🏦 Você esqueceu de me dizer o banco! De qual banco devo descontar esse gasto?")
                 return
 
-            cur.execute("INSERT INTO transactions (user_id, amount, category, description, type) VALUES (%s, %s, %s, %s, 'expense')",
+            cur.execute("INSERT INTO transactions (user_id, amount, category, description, type) VALUES (%s, %s, %s, %s, 'expense') RETURNING id",
                         (user_id, data['amount'], data['category'], data['description']))
-            cur.execute("UPDATE accounts SET balance = balance - %s WHERE user_id = %s AND bank_name ILIKE %s",
-                        (data['amount'], user_id, f"%{data['bank']}%"))
+            tx_id = cur.fetchone()[0]
+            status, conta = name_resolver.apply(
+                cur, user_id, 'bank', data['bank'],
+                lambda conta: ledger_post(cur, conta[0], user_id, -data['amount'], 'expense', tx_id) is not None
+            )
+            if status == 'ambiguous':
+                conn.rollback()
+                ask_to_pick(message, cur, user_id, data, 'bank', 'banco', conta)
+                return
             conn.commit()
             
-            reply_msg = f"✅ Gasto de R$ {data['amount']:.2f} salvo em {data['category']} descontado do {data['bank']}!"
+            if status == 'ok':
+                reply_msg = f"✅ Gasto de R$ {data['amount']:.2f} salvo em {data['category']} descontado do {conta[1]}!"
+            else:
+                reply_msg = f"✅ Gasto de R$ {data['amount']:.2f} salvo em {data['category']}!\n⚠️ Não encontrei o banco {data['bank']}, então nenhum saldo foi descontado."
             bot.reply_to(message, reply_msg)
 
         elif action == 'check_goal':
             cat = data.get('category', '')
-            cur.execute("SELECT goal_amount FROM category_goals WHERE user_id = %s AND category ILIKE %s", (user_id, f"%{cat}%"))
-            goal_res = cur.fetchone()
-            if goal_res:
+            status, meta_encontrada = name_resolver.resolve(cur, user_id, 'goal', cat)
+            goal_res = None
+            if status == 'ok':
+                cat = meta_encontrada[1]
+                cur.execute("""
+                    SELECT g.goal_amount, COALESCE(s.total, 0)
+                    FROM category_goals g
+                    LEFT JOIN category_month_spend s
+                        ON s.user_id = g.user_id AND s.category = upper(g.category)
+                       AND s.month = date_trunc('month', CURRENT_DATE)::date
+                    WHERE g.user_id = %s AND g.category = %s
+                """, (user_id, cat))
+                goal_res = cur.fetchone()
+            if status == 'ambiguous':
+                ask_to_pick(message, cur, user_id, data, 'category', 'meta', meta_encontrada)
+            elif goal_res:
                 meta = float(goal_res[0])
-                cur.execute("SELECT SUM(amount) FROM transactions WHERE user_id = %s AND category ILIKE %s AND date >= date_trunc('month', CURRENT_DATE)", (user_id, f"%{cat}%"))
-                total_gasto = float(cur.fetchone()[0] or 0)
+                total_gasto = float(goal_res[1])
                 restante = meta - total_gasto
                 
                 mensagem = f"🎯 **Resumo da Meta: {cat}**\n\n🔸 **Sua Meta:** R$ {meta:.2f}\n💸 **Total Gasto:** R$ {total_gasto:.2f}\n"
@@ -331,15 +2851,23 @@ def handle_message(message):
 
         # --- NOVAS FUNÇÕES COMPATÍVEIS ---
         elif action == 'list_goals':
-            cur.execute("SELECT category, goal_amount FROM category_goals WHERE user_id = %s AND goal_amount > 0 ORDER BY category", (user_id,))
+            # Uma única consulta: metas + gasto do mês vindo do resumo mensal por categoria
+            cur.execute("""
+                SELECT g.category, g.goal_amount, COALESCE(s.total, 0)
+                FROM category_goals g
+                LEFT JOIN category_month_spend s
+                    ON s.user_id = g.user_id AND s.category = upper(g.category)
+                   AND s.month = date_trunc('month', CURRENT_DATE)::date
+                WHERE g.user_id = %s AND g.goal_amount > 0
+                ORDER BY g.category
+            """, (user_id,))
             metas = cur.fetchall()
             if metas:
                 mensagem = "🎯 **Resumo de Todas as Metas:**\n\n"
                 total_livre = 0.0
-                for cat, meta in metas:
+                for cat, meta, gasto in metas:
                     meta = float(meta)
-                    cur.execute("SELECT SUM(amount) FROM transactions WHERE user_id = %s AND category ILIKE %s AND date >= date_trunc('month', CURRENT_DATE)", (user_id, f"%{cat}%"))
-                    gasto = float(cur.fetchone()[0] or 0)
+                    gasto = float(gasto)
                     restante = meta - gasto
                     mensagem += f"🔸 **{cat}** (Meta: R$ {meta:.2f})\n"
                     if restante >= 0:
@@ -354,29 +2882,28 @@ def handle_message(message):
 
         # --- GESTÃO ADAPTADA: ADICIONAR CONTA A PAGAR (TABELA: unpaid_bills) ---
         elif action == 'add_bill':
-            mes = data.get('month') or meses_pt[hoje.month]
             categoria = data.get('category', 'GERAL')
-            mes_alvo = meses_num.get(mes.lower(), hoje.month)
-            vencimento = datetime(hoje.year, mes_alvo, 10)
+            ano_alvo, mes_alvo, mes = resolve_month(data.get('month'), hoje)
+            vencimento = datetime(ano_alvo, mes_alvo, 10)
             
             cur.execute("""
                 INSERT INTO unpaid_bills (user_id, amount, category, description, due_date, is_paid) 
                 VALUES (%s, %s, %s, %s, %s, false)
             """, (user_id, data['amount'], categoria, data['description'], vencimento))
             conn.commit()
-            bot.reply_to(message, f"🧾 Conta/Fatura de {data['month']} anotada com sucesso e visível no seu Dashboard!")
+            bot.reply_to(message, f"🧾 Conta/Fatura de {mes} anotada com sucesso e visível no seu Dashboard!")
 
         # --- GESTÃO ADAPTADA: LISTAR CONTAS A PAGAR (UNIFICADO) ---
         elif action == 'list_bills':
-            mes = data.get('month') or meses_pt[hoje.month]
-            mes_alvo = meses_num.get(mes.lower(), hoje.month)
+            ano_alvo, mes_alvo, mes = resolve_month(data.get('month'), hoje)
+            inicio, fim = month_range(ano_alvo, mes_alvo)
             
             # Busca contas em unpaid_bills
-            cur.execute("SELECT description, amount FROM unpaid_bills WHERE user_id = %s AND is_paid = false AND EXTRACT(MONTH FROM due_date) = %s", (user_id, mes_alvo))
+            cur.execute("SELECT description, amount FROM unpaid_bills WHERE user_id = %s AND is_paid = false AND due_date >= %s AND due_date < %s ORDER BY due_date", (user_id, inicio, fim))
             contas = cur.fetchall()
             
             # Busca parcelas de cartão em scheduled_expenses
-            cur.execute("SELECT description, amount, card_name FROM scheduled_expenses WHERE user_id = %s AND is_active = true AND EXTRACT(MONTH FROM due_date) = %s", (user_id, mes_alvo))
+            cur.execute("SELECT description, amount, card_name FROM scheduled_expenses WHERE user_id = %s AND is_active = true AND due_date >= %s AND due_date < %s ORDER BY due_date", (user_id, inicio, fim))
             cartoes = cur.fetchall()
             
             if contas or cartoes:
@@ -394,14 +2921,77 @@ def handle_message(message):
             else:
                 bot.reply_to(message, f"✅ Nenhuma conta a pagar pendente para {mes}.")
 
+        # --- RELATÓRIOS POR PERÍODO ---
+        elif action in ('get_report', 'report_category'):
+            periodo = data.get('period') if data.get('period') in PERIODOS_PT else 'month'
+            inicio, fim = period_range(periodo, hoje)
+            cat = data.get('category', '') if action == 'report_category' else None
+            if cat:
+                status, categoria = name_resolver.resolve(cur, user_id, 'category', cat)
+                if status == 'ok':
+                    cat = categoria[1].upper()
+            rel = run_report(cur, user_id, 'spending', inicio, fim, cat)
+            titulo = f"{PERIODOS_PT[periodo]} em {cat}" if cat else PERIODOS_PT[periodo]
+            if rel['count']:
+                mensagem = f"📊 **Relatório ({titulo}):**\n\n"
+                if not cat:
+                    for categoria, total, qtd in rel['categories']:
+                        mensagem += f"🔸 {categoria or 'GERAL'}: R$ {total:.2f} ({qtd}x)\n"
+                    mensagem += "\n"
+                mensagem += f"💸 **Total gasto:** R$ {rel['total']:.2f} em {rel['count']} lançamento(s)"
+            else:
+                mensagem = f"📊 Nenhum gasto registrado ({titulo})."
+            if rel.get('bills_count'):
+                mensagem += f"\n⏳ **Contas com vencimento no período:** R$ {rel['bills_total']:.2f} ({rel['bills_count']})"
+            bot.reply_to(message, mensagem.replace('.', ','), parse_mode="Markdown")
+
+        elif action == 'total_bills':
+            ano_alvo, mes_alvo, mes = resolve_month(data.get('month'), hoje)
+            inicio, fim = month_range(ano_alvo, mes_alvo)
+            rel = run_report(cur, user_id, 'bills', inicio, fim)
+            if rel['count']:
+                bot.reply_to(message, f"🧾 **Total de contas pendentes ({mes}):** R$ {rel['total']:.2f} em {rel['count']} conta(s)".replace('.', ','), parse_mode="Markdown")
+            else:
+                bot.reply_to(message, f"✅ Nenhuma conta a pagar pendente para {mes}.")
+
+        # --- EXPORTAÇÃO DO HISTÓRICO ---
+        elif action == 'export_data':
+            formato = 'xlsx' if str(data.get('format', '')).lower() in ('xlsx', 'excel') else 'csv'
+            if data.get('month'):
+                ano_alvo, mes_alvo, rotulo = resolve_month(data.get('month'), hoje)
+                inicio, fim = month_range(ano_alvo, mes_alvo)
+            else:
+                inicio, fim, rotulo = None, None, 'Todo o histórico'
+            # Gera o arquivo fora da fila do webhook, como a importação
+            threading.Thread(
+                target=run_export, args=(chat_id, user_id, inicio, fim, formato, rotulo),
+                name=f"export-{chat_id}", daemon=True
+            ).start()
+            bot.reply_to(message, f"📦 Gerando sua exportação em {formato.upper()} ({rotulo}). Já te envio o arquivo!")
+
         # --- OUTROS RELATÓRIOS E SALDOS ---
         elif action == 'get_balance':
-            cur.execute("SELECT bank_name, balance FROM accounts WHERE user_id = %s ORDER BY bank_name", (user_id,))
-            rows = cur.fetchall()
+            data_saldo = resolve_balance_date(data.get('date'), hoje) if data.get('date') else None
+            inicio_historico = ledger_start(cur, user_id) if data_saldo else None
+            if data.get('date') and data_saldo is None:
+                bot.reply_to(message, "❌ Não entendi a data. Tente algo como \"saldo em 30/09\".")
+                return
+            if data_saldo and (inicio_historico is None or inicio_historico.date() > data_saldo):
+                desde = f"Ele começa em {inicio_historico:%d/%m/%Y}." if inicio_historico else "Ainda não há lançamentos nos seus bancos."
+                bot.reply_to(message, f"📅 Não tenho o histórico de saldos de {data_saldo:%d/%m/%Y}. {desde}")
+                return
+            if data_saldo:
+                # Saldo no fim do dia pedido
+                rows = balances_at(cur, user_id, datetime.combine(data_saldo, datetime.min.time()) + timedelta(days=1))
+                titulo = f"Seus Saldos em {data_saldo:%d/%m/%Y}"
+            else:
+                cur.execute("SELECT bank_name, balance FROM accounts WHERE user_id = %s ORDER BY bank_name", (user_id,))
+                rows = cur.fetchall()
+                titulo = "Seus Saldos"
             if rows:
                 total_saldo = sum([float(r[1]) for r in rows])
                 msg = "\n".join([f"🏦 {r[0]}: R$ {float(r[1]):.2f}".replace('.', ',') for r in rows])
-                resposta = f"💰 **Seus Saldos:**\n{msg}\n\n✅ **Saldo total:** R$ {total_saldo:.2f}".replace('.', ',')
+                resposta = f"💰 **{titulo}:**\n{msg}\n\n✅ **Saldo total:** R$ {total_saldo:.2f}".replace('.', ',')
                 bot.reply_to(message, resposta, parse_mode="Markdown")
             else:
                 bot.reply_to(message, "Você ainda não tem saldos cadastrados nos bancos.")
@@ -409,15 +2999,57 @@ def handle_message(message):
         else:
             bot.reply_to(message, f"Oi Maique! Como posso ajudar?")
 
+        if action in ACOES_DE_ESCRITA:
+            name_resolver.invalidate(user_id)
+
     except Exception as e:
         erro_msg = traceback.format_exc()
         print(f"Erro Crítico: {erro_msg}", flush=True)
+        metrics.inc('zap_update_errors_total')
         bot.reply_to(message, "Oops! Houve um erro interno de estrutura. Tente novamente!")
     finally:
         if conn:
             cur.close()
-            conn.close()
+            release_db(conn)
+        finish_trace(action)
+        clear_deadline()
+
+@bot.message_handler(content_types=['document'])
+def handle_document(message):
+    doc = message.document
+    nome = (doc.file_name or '').lower()
+    if not nome.endswith(('.csv', '.ofx')):
+        bot.reply_to(message, "📄 Para importar um extrato, me envie um arquivo **.csv** ou **.ofx**.", parse_mode="Markdown")
+        return
+    if doc.file_size and doc.file_size > IMPORT_MAX_FILE_SIZE:
+        bot.reply_to(message, "❌ O arquivo é grande demais (máximo de 20 MB). Divida o extrato em partes.")
+        return
+
+    conn = get_db()
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT id FROM users WHERE telegram_chat_id = %s", (int(message.chat.id),))
+        user = cur.fetchone()
+        cur.close()
+    finally:
+        release_db(conn)
+    if not user:
+        bot.reply_to(message, "Me mande uma mensagem antes de importar um extrato, para eu te cadastrar.")
+        return
+
+    file_path = bot.get_file(doc.file_id).file_path
+    # A importação roda fora da fila do webhook para não travar as mensagens de outros chats
+    threading.Thread(
+        target=run_statement_import,
+        args=(message.chat.id, user[0], file_path, nome, message.caption or ''),
+        name=f"import-{message.chat.id}", daemon=True
+    ).start()
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'send_reminders':
+        # Uso no cron: python app.py send_reminders [dias]
+        dias = int(sys.argv[2]) if len(sys.argv) > 2 else REMINDER_DAYS_AHEAD
+        print(json.dumps(send_bill_reminders(dias)), flush=True)
+        sys.exit(0)
     port = int(os.environ.get('PORT', 10000))
     app.run(host="0.0.0.0", port=port)
\ No newline at end of file
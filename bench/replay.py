@@ -0,0 +1,417 @@
+"""Benchmark de carga/replay do webhook do ZapFinanceiro.
+
+Gera updates sintéticos do Telegram cobrindo todos os ramos de handle_message e os
+envia para a rota webhook() do Flask (em processo, via test_client) com a
+concorrência escolhida. Cada chat manda suas mensagens em sequência, esperando a
+resposta de uma antes da próxima, e a resposta é conferida contra o ramo esperado.
+A Groq e a API do Telegram são trocadas por servidores
+locais com latência configurável (bench/stubs.py) e o banco é um Postgres
+descartável: sem --dsn, um cluster temporário é criado com initdb/pg_ctl e
+apagado no fim.
+
+Exemplos:
+
+    python bench/replay.py --updates 2000 --concurrency 8 --output bench_output.json
+    python bench/replay.py --dsn postgresql://localhost/zap_bench --reset-db --mode async
+
+A saída é um JSON com p50/p95/p99 e updates/s por ação, para comparar execuções.
+"""
+import argparse
+import importlib
+import json
+import math
+import os
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import psycopg2
+
+AQUI = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, AQUI)
+sys.path.insert(0, os.path.dirname(AQUI))
+
+from stubs import GroqStub, TelegramStub  # noqa: E402
+
+BENCH_TOKEN = '123456:BENCH'
+CHAT_BASE = 900000
+
+
+# --- POSTGRES DESCARTÁVEL ---
+class TempPostgres:
+    def __init__(self):
+        self.dir = None
+        self.port = None
+
+    def _porta_livre(self):
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            return s.getsockname()[1]
+
+    def start(self):
+        for binario in ('initdb', 'pg_ctl'):
+            if not shutil.which(binario):
+                raise SystemExit(f"'{binario}' não está no PATH: instale o Postgres ou passe --dsn.")
+        self.dir = tempfile.mkdtemp(prefix='zap-bench-pg-')
+        self.port = self._porta_livre()
+        dados = os.path.join(self.dir, 'data')
+        subprocess.run(['initdb', '-D', dados, '-U', 'bench', '--auth=trust', '-E', 'UTF8'],
+                       check=True, stdout=subprocess.DEVNULL)
+        opcoes = f"-p {self.port} -k {self.dir} -c listen_addresses='' -c fsync=off -c max_connections=200"
+        subprocess.run(['pg_ctl', '-D', dados, '-o', opcoes, '-l', os.path.join(self.dir, 'log'), '-w', 'start'],
+                       check=True, stdout=subprocess.DEVNULL)
+        return f"host={self.dir} port={self.port} user=bench dbname=postgres"
+
+    def stop(self):
+        if self.dir:
+            subprocess.run(['pg_ctl', '-D', os.path.join(self.dir, 'data'), '-m', 'immediate', 'stop'],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def prepare_database(dsn, users, history, reset):
+    conn = psycopg2.connect(dsn)
+    cur = conn.cursor()
+    cur.execute("SELECT to_regclass('transactions') IS NOT NULL")
+    if cur.fetchone()[0] and not reset:
+        raise SystemExit("O banco já tem a tabela transactions. Use --reset-db para apagar e recriar (só em banco descartável!).")
+    with open(os.path.join(AQUI, 'schema.sql')) as f:
+        cur.execute(f.read())
+
+    cur.execute("""
+        INSERT INTO users (name, email, password, telegram_chat_id)
+        SELECT 'Bench ' || g, 'bench' || g || '@example.com', 'x', %s + g FROM generate_series(0, %s - 1) g
+    """, (CHAT_BASE, users))
+    cur.execute("""
+        INSERT INTO accounts (user_id, bank_name, balance)
+        SELECT u.id, b.nome, 1000 FROM users u, unnest(ARRAY['NUBANK', 'ITAÚ', 'INTER']) AS b(nome)
+    """)
+    cur.execute("""
+        INSERT INTO categories (user_id, name, type)
+        SELECT u.id, c.nome, 'expense' FROM users u, unnest(ARRAY['MERCADO', 'TRANSPORTE', 'SAÚDE']) AS c(nome)
+    """)
+    # category_goals tem UNIQUE (category) no app, então cada usuário tem a sua meta própria
+    cur.execute("""
+        INSERT INTO category_goals (user_id, category, goal_amount)
+        SELECT u.id, 'LAZER ' || (u.telegram_chat_id - %s), 500 FROM users u
+    """, (CHAT_BASE,))
+    # Histórico espalhado pelos últimos anos para as consultas por período terem volume
+    cur.execute("""
+        INSERT INTO transactions (user_id, amount, category, description, type, date)
+        SELECT u.id, round((random() * 200)::numeric, 2),
+               (ARRAY['MERCADO', 'TRANSPORTE', 'SAÚDE', 'LAZER ' || (u.telegram_chat_id - %s)])[1 + mod(g, 4)],
+               'Histórico ' || g, 'expense', now() - g * INTERVAL '3 hours'
+        FROM users u, generate_series(1, %s) g
+    """, (CHAT_BASE, history))
+    cur.execute("""
+        INSERT INTO unpaid_bills (user_id, amount, category, description, due_date, is_paid)
+        SELECT u.id, 100 + g, 'CASA', 'Conta ' || g, (date_trunc('month', now()) + (g - 12) * INTERVAL '1 month')::date + 9, mod(g, 3) = 0
+        FROM users u, generate_series(1, 36) g
+    """)
+    cur.execute("""
+        INSERT INTO scheduled_expenses (user_id, amount, description, is_active, card_name, due_date)
+        SELECT u.id, 50, 'Parcela ' || g, true, 'NUBANK', (date_trunc('month', now()) + (g - 12) * INTERVAL '1 month')::date + 9
+        FROM users u, generate_series(1, 36) g
+    """)
+    conn.commit()
+    cur.execute("ANALYZE")
+    conn.close()
+
+
+# --- CENÁRIOS ---
+# Cada job é uma lista de passos (ação, texto, resposta da IA ou None quando o parser
+# local resolve). Os passos de um job rodam em sequência no mesmo chat.
+def build_job(tipo, i, n):
+    sufixo = f"{i}-{n}"
+    jobs = {
+        'get_balance': [('get_balance', 'saldo', None)],
+        'list_goals': [('list_goals', 'listar metas', None)],
+        'list_bills': [('list_bills', 'contas de novembro', None)],
+        'add_expense': [('add_expense', f"gastei {10 + n % 90} no mercado pelo nubank", None)],
+        'add_expense_ai': [('add_expense', f"comprei remédio de {20 + n % 50} reais, paguei com o itaú",
+                            {'action': 'add_expense', 'amount': float(20 + n % 50), 'category': 'SAÚDE',
+                             'description': 'Remédio', 'bank': 'ITAÚ'})],
+        'provide_bank': [
+            ('add_expense_no_bank', f"gastei {5 + n % 20} no transporte", None),
+            ('provide_bank', 'inter', None),
+        ],
+        'delete_last': [('delete_last', 'apagar último gasto', None)],
+        'add_income': [('add_income', f"recebi {1000 + n} de salário no nubank",
+                        {'action': 'add_income', 'amount': float(1000 + n), 'bank': 'NUBANK', 'description': 'Salário'})],
+        'set_goal': [('set_goal', f"meta de {300 + n} para lazer {i}",
+                      {'action': 'set_goal', 'amount': float(300 + n), 'category': f'LAZER {i}'})],
+        'check_goal': [('check_goal', f"como está minha meta de lazer {i}",
+                        {'action': 'check_goal', 'category': f'LAZER {i}'})],
+        'credit_card': [('add_credit_card_purchase', f"comprei uma tv de {1200 + n} em 6x no cartão nubank",
+                         {'action': 'add_credit_card_purchase', 'amount': float(1200 + n), 'installments': 6,
+                          'description': 'TV', 'card': 'NUBANK', 'category': 'CASA'})],
+        'bill': [
+            ('add_bill', f"anota a conta de luz {sufixo} de {150 + n % 50} para dezembro",
+             {'action': 'add_bill', 'amount': float(150 + n % 50), 'description': f'Luz {sufixo}',
+              'month': 'Dezembro', 'category': 'CASA'}),
+            ('delete_bill', f"apaga a conta de luz {sufixo} de dezembro",
+             {'action': 'delete_bill', 'description': f'Luz {sufixo}', 'month': 'Dezembro'}),
+        ],
+        'bank_crud': [
+            ('create_bank', f"cria o banco teste {sufixo}", {'action': 'create_bank', 'bank': f'TESTE {sufixo}'}),
+            ('update_bank', f"muda o banco teste {sufixo} para novo {sufixo}",
+             {'action': 'update_bank', 'old_bank': f'TESTE {sufixo}', 'new_bank': f'NOVO {sufixo}'}),
+            ('delete_bank', f"apaga o banco novo {sufixo}", {'action': 'delete_bank', 'bank': f'NOVO {sufixo}'}),
+        ],
+        'category_crud': [
+            ('create_category', f"cria a categoria teste {sufixo}", {'action': 'create_category', 'category': f'TESTE {sufixo}'}),
+            ('update_category', f"muda a categoria teste {sufixo} para nova {sufixo}",
+             {'action': 'update_category', 'old_category': f'TESTE {sufixo}', 'new_category': f'NOVA {sufixo}'}),
+            ('delete_category', f"apaga a categoria nova {sufixo}", {'action': 'delete_category', 'category': f'NOVA {sufixo}'}),
+        ],
+        'get_report': [('get_report', 'relatório do mês', {'action': 'get_report', 'period': 'month'})],
+        'report_category': [('report_category', 'quanto gastei com mercado essa semana',
+                             {'action': 'report_category', 'category': 'MERCADO', 'period': 'week'})],
+        'total_bills': [('total_bills', 'total das contas de janeiro', {'action': 'total_bills', 'month': 'Janeiro'})],
+        'chat': [('chat', 'bom dia, tudo bem?', {'action': 'chat'})],
+    }
+    return jobs[tipo]
+
+JOB_TYPES = [
+    'get_balance', 'list_goals', 'list_bills', 'add_expense', 'add_expense_ai', 'provide_bank', 'delete_last',
+    'add_income', 'set_goal', 'check_goal', 'credit_card', 'bill', 'bank_crud', 'category_crud',
+    'get_report', 'report_category', 'total_bills', 'chat',
+]
+
+# Trecho que a resposta precisa ter para o passo contar como o ramo planejado
+RESPOSTAS_ESPERADAS = {
+    'get_balance': r'Seus Saldos',
+    'list_goals': r'Resumo de Todas as Metas|não tem metas',
+    'list_bills': r'Contas a pagar pendentes|Nenhuma conta a pagar',
+    'add_expense': r'Gasto de R\$',
+    'add_expense_no_bank': r'esqueceu de me dizer o banco',
+    'provide_bank': r'Gasto de R\$ .* descontado do INTER',
+    'delete_last': r'Último gasto apagado|Não encontrei nenhum gasto',
+    'add_income': r'adicionados ao',
+    'set_goal': r'Meta de R\$',
+    'check_goal': r'Resumo da Meta|ainda não definiu',
+    'add_credit_card_purchase': r'Compra (parcelada|à vista)',
+    'add_bill': r'anotada com sucesso',
+    'delete_bill': r'foi excluída',
+    'create_bank': r'criado com sucesso',
+    'update_bank': r'foi alterado para',
+    'delete_bank': r'foi apagada',
+    'create_category': r'criada com sucesso',
+    'update_category': r'alterada para',
+    'delete_category': r'deletada',
+    'get_report': r'Relatório|Nenhum gasto registrado',
+    'report_category': r'Relatório|Nenhum gasto registrado',
+    'total_bills': r'Total de contas pendentes|Nenhuma conta a pagar',
+    'chat': r'Como posso ajudar',
+}
+
+
+def make_update(update_id, message_id, chat_id, text):
+    return json.dumps({
+        'update_id': update_id,
+        'message': {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private', 'first_name': 'Bench'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Bench'},
+            'text': text,
+        },
+    })
+
+
+# --- EXECUÇÃO ---
+class Runner:
+    def __init__(self, app_module, telegram, mode, reply_timeout):
+        self.app = app_module
+        self.telegram = telegram
+        self.mode = mode
+        self.reply_timeout = reply_timeout
+        self.results = []
+        self._lock = threading.Lock()
+        self._ids = iter(range(1, 10 ** 9))
+        self._local = threading.local()
+
+    def _client(self):
+        if not hasattr(self._local, 'client'):
+            self._local.client = self.app.app.test_client()
+        return self._local.client
+
+    def _next_id(self):
+        with self._lock:
+            return next(self._ids)
+
+    def run_chat(self, chat_id, jobs):
+        # Os jobs de um mesmo chat rodam em sequência, como um usuário real mandando mensagens
+        for passos in jobs:
+            self.run_job(chat_id, passos)
+
+    def run_job(self, chat_id, passos):
+        for action, text, _ in passos:
+            update_id = self._next_id()
+            message_id = self._next_id()
+            inicio = time.perf_counter()
+            resp = self._client().post(f'/{BENCH_TOKEN}', data=make_update(update_id, message_id, chat_id, text),
+                                       content_type='application/json')
+            fim_http = time.perf_counter()
+            erro = None
+            if resp.status_code != 200:
+                erro = f"http_{resp.status_code}"
+                latencia = fim_http - inicio
+            else:
+                espera = 0 if self.mode == 'sync' else self.reply_timeout
+                resposta = self.telegram.wait_reply(chat_id, message_id, espera)
+                if resposta is None:
+                    erro = 'no_reply'
+                    latencia = fim_http - inicio
+                else:
+                    instante, texto = resposta
+                    latencia = (fim_http if self.mode == 'sync' else instante) - inicio
+                    if texto.startswith('Oops!'):
+                        erro = 'internal_error'
+                    elif not re.search(RESPOSTAS_ESPERADAS[action], texto):
+                        # Outro ramo respondeu (ex.: pendência consumida por outra mensagem)
+                        erro = 'unexpected_reply'
+            with self._lock:
+                self.results.append((action, latencia, erro, time.perf_counter()))
+
+
+def percentile(valores, p):
+    if not valores:
+        return None
+    ordenados = sorted(valores)
+    # Nearest-rank: o menor valor com pelo menos p% das amostras até ele
+    k = max(0, min(len(ordenados) - 1, math.ceil(p / 100 * len(ordenados)) - 1))
+    return ordenados[k]
+
+
+def summarize(results, duracao):
+    def resumo(itens):
+        latencias = [r[1] * 1000 for r in itens]
+        return {
+            'count': len(itens),
+            'errors': sum(1 for r in itens if r[2]),
+            'p50_ms': round(percentile(latencias, 50), 2),
+            'p95_ms': round(percentile(latencias, 95), 2),
+            'p99_ms': round(percentile(latencias, 99), 2),
+            'mean_ms': round(sum(latencias) / len(latencias), 2),
+            'max_ms': round(max(latencias), 2),
+            'updates_per_sec': round(len(itens) / duracao, 2) if duracao else None,
+        }
+
+    por_acao = {}
+    for r in results:
+        por_acao.setdefault(r[0], []).append(r)
+    erros = {}
+    for r in results:
+        if r[2]:
+            erros[r[2]] = erros.get(r[2], 0) + 1
+    return {
+        'overall': resumo(results) if results else {},
+        'actions': {acao: resumo(itens) for acao, itens in sorted(por_acao.items())},
+        'error_kinds': erros,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay de updates sintéticos contra o webhook do ZapFinanceiro.")
+    parser.add_argument('--updates', type=int, default=500, help="quantidade de jobs (cada job tem de 1 a 3 updates)")
+    parser.add_argument('--concurrency', type=int, default=4, help="chats atendidos em paralelo (no máximo --users)")
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--history', type=int, default=2000, help="transações históricas por usuário")
+    parser.add_argument('--mode', choices=('sync', 'async'), default='sync',
+                        help="sync: WEBHOOK_ASYNC=0 e mede a requisição; async: mede até a resposta chegar no Telegram falso")
+    parser.add_argument('--groq-latency', type=float, default=300, help="ms")
+    parser.add_argument('--groq-jitter', type=float, default=50, help="ms")
+    parser.add_argument('--groq-failure-rate', type=float, default=0.0)
+    parser.add_argument('--telegram-latency', type=float, default=40, help="ms")
+    parser.add_argument('--telegram-jitter', type=float, default=10, help="ms")
+    parser.add_argument('--reply-timeout', type=float, default=60, help="segundos (modo async)")
+    parser.add_argument('--no-ai-cache', action='store_true', help="desliga o cache de respostas da IA")
+    parser.add_argument('--dsn', help="Postgres descartável já existente (senão cria um temporário)")
+    parser.add_argument('--reset-db', action='store_true', help="apaga e recria as tabelas do --dsn")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help="arquivo JSON de saída (padrão: stdout)")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    temp_pg = None
+    groq = GroqStub(args.groq_latency, args.groq_jitter, args.groq_failure_rate).start()
+    telegram = TelegramStub(args.telegram_latency, args.telegram_jitter).start()
+    try:
+        dsn = args.dsn
+        if not dsn:
+            temp_pg = TempPostgres()
+            dsn = temp_pg.start()
+        prepare_database(dsn, args.users, args.history, reset=args.reset_db or temp_pg is not None)
+
+        # O app lê a configuração ao ser importado
+        os.environ.update({
+            'TELEGRAM_TOKEN': BENCH_TOKEN,
+            'DB_URI': dsn,
+            'GROQ_API_KEY': 'bench',
+            'GROQ_BASE_URL': groq.url,
+            'WEBHOOK_ASYNC': '1' if args.mode == 'async' else '0',
+            'DB_POOL_MAX': str(max(5, args.concurrency + 2)),
+        })
+        if args.no_ai_cache:
+            os.environ['AI_CACHE_SIZE'] = '0'
+        import telebot.apihelper
+        telebot.apihelper.API_URL = telegram.url + "/bot{0}/{1}"
+        app_module = importlib.import_module('app')
+
+        jobs = {}
+        for n in range(args.updates):
+            i = random.randrange(args.users)
+            passos = build_job(random.choice(JOB_TYPES), i, n)
+            for _, text, resposta in passos:
+                if resposta is not None:
+                    groq.register(text, resposta)
+            jobs.setdefault(CHAT_BASE + i, []).append(passos)
+
+        runner = Runner(app_module, telegram, args.mode, args.reply_timeout)
+        # Aquece o pool e aplica as migrações fora da medição
+        app_module.release_db(app_module.get_db())
+
+        inicio = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            for futuro in [executor.submit(runner.run_chat, chat_id, lista) for chat_id, lista in jobs.items()]:
+                futuro.result()
+        duracao = time.perf_counter() - inicio
+
+        saida = {
+            'started_at': datetime.now().isoformat(timespec='seconds'),
+            'config': {k: v for k, v in vars(args).items() if k not in ('dsn', 'output')},
+            'duration_s': round(duracao, 3),
+            'total_updates': len(runner.results),
+            'throughput_ups': round(len(runner.results) / duracao, 2) if duracao else None,
+            **summarize(runner.results, duracao),
+            'stubs': {'groq_requests': groq.requests, 'telegram_requests': telegram.requests},
+            'app_stats': app_module.collect_stats(),
+        }
+        texto = json.dumps(saida, indent=2, ensure_ascii=False, default=str)
+        if args.output:
+            with open(args.output, 'w') as f:
+                f.write(texto + "\n")
+        else:
+            print(texto)
+    finally:
+        groq.shutdown()
+        telegram.shutdown()
+        if temp_pg:
+            try:
+                importlib.import_module('app').get_pool().closeall()
+            except Exception:
+                pass
+            temp_pg.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+-- Esquema mínimo usado pelo bot, só para o benchmark em um Postgres descartável.
+-- As migrações do app.py (schema_migrations, category_month_spend, índices...) são
+-- aplicadas pelo próprio app na primeira conexão, como em produção.
+
+DROP TABLE IF EXISTS users, accounts, transactions, categories, category_goals,
+    unpaid_bills, scheduled_expenses, schema_migrations, category_month_spend,
+    pending_actions, ai_cache, deferred_messages, bill_reminders, account_ledger, account_snapshots, processed_updates CASCADE;
+
+CREATE TABLE users (
+    id SERIAL PRIMARY KEY,
+    name TEXT,
+    email TEXT,
+    password TEXT,
+    telegram_chat_id BIGINT UNIQUE
+);
+
+CREATE TABLE accounts (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users (id),
+    bank_name TEXT NOT NULL,
+    balance NUMERIC(14, 2) NOT NULL DEFAULT 0,
+    UNIQUE (user_id, bank_name)
+);
+
+CREATE TABLE transactions (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users (id),
+    amount NUMERIC(14, 2) NOT NULL,
+    category TEXT,
+    description TEXT,
+    type TEXT NOT NULL DEFAULT 'expense',
+    date TIMESTAMP NOT NULL DEFAULT (CURRENT_TIMESTAMP AT TIME ZONE 'UTC' - INTERVAL '3 hours')
+);
+
+CREATE TABLE categories (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users (id),
+    name TEXT NOT NULL,
+    type TEXT NOT NULL DEFAULT 'expense'
+);
+
+CREATE TABLE category_goals (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users (id),
+    category TEXT NOT NULL UNIQUE,
+    goal_amount NUMERIC(14, 2) NOT NULL
+);
+
+CREATE TABLE unpaid_bills (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users (id),
+    amount NUMERIC(14, 2) NOT NULL,
+    category TEXT,
+    description TEXT,
+    due_date DATE NOT NULL,
+    is_paid BOOLEAN NOT NULL DEFAULT false
+);
+
+CREATE TABLE scheduled_expenses (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users (id),
+    amount NUMERIC(14, 2) NOT NULL,
+    description TEXT,
+    is_active BOOLEAN NOT NULL DEFAULT true,
+    card_name TEXT,
+    due_date DATE NOT NULL
+);
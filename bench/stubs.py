@@ -0,0 +1,153 @@
+"""Servidores falsos da Groq e da API do Telegram para o benchmark.
+
+Os dois rodam em threads locais com latência configurável, e o app aponta para
+eles via GROQ_BASE_URL e telebot.apihelper.API_URL.
+"""
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class _StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, handler, latency_ms, jitter_ms):
+        super().__init__(('127.0.0.1', 0), handler)
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def wait_latency(self):
+        with self._lock:
+            self.requests += 1
+        atraso = self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)
+        if atraso > 0:
+            time.sleep(atraso / 1000)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class _QuietHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def _body(self):
+        tamanho = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(tamanho) if tamanho else b''
+
+    def _send_json(self, payload, status=200):
+        corpo = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(corpo)))
+        self.end_headers()
+        self.wfile.write(corpo)
+
+
+class GroqStub(_StubServer):
+    """Responde /openai/v1/chat/completions com o JSON registrado para o texto do usuário."""
+
+    def __init__(self, latency_ms=300, jitter_ms=0, failure_rate=0.0):
+        super().__init__(_GroqHandler, latency_ms, jitter_ms)
+        self.failure_rate = failure_rate
+        self.responses = {}
+
+    def register(self, text, data):
+        self.responses[text] = data
+
+
+class _GroqHandler(_QuietHandler):
+    def do_POST(self):
+        server = self.server
+        payload = json.loads(self._body() or b'{}')
+        server.wait_latency()
+        if server.failure_rate and random.random() < server.failure_rate:
+            self._send_json({'error': {'message': 'stub failure', 'type': 'server_error'}}, status=503)
+            return
+        texto = next((m['content'] for m in reversed(payload.get('messages', [])) if m.get('role') == 'user'), '')
+        data = server.responses.get(texto, {'action': 'chat'})
+        self._send_json({
+            'id': 'chatcmpl-bench',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': payload.get('model', 'stub'),
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': json.dumps(data, ensure_ascii=False)},
+                'finish_reason': 'stop',
+            }],
+            'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0},
+        })
+
+
+class TelegramStub(_StubServer):
+    """Imita os métodos da Bot API usados pelo app e registra quando cada resposta chegou.
+
+    As respostas são indexadas por (chat_id, message_id respondido), o que permite medir
+    a latência de ponta a ponta quando o webhook processa em segundo plano.
+    """
+
+    def __init__(self, latency_ms=50, jitter_ms=0):
+        super().__init__(_TelegramHandler, latency_ms, jitter_ms)
+        self.replies = {}
+        self._cond = threading.Condition()
+        self._next_id = 1
+
+    def record_reply(self, chat_id, reply_to, text):
+        with self._cond:
+            self.replies[(chat_id, reply_to)] = (time.perf_counter(), text)
+            self._next_id += 1
+            self._cond.notify_all()
+            return self._next_id
+
+    def wait_reply(self, chat_id, reply_to, timeout):
+        """Retorna (instante, texto) da resposta ou None se ela não chegar a tempo."""
+        prazo = time.monotonic() + timeout
+        with self._cond:
+            while (chat_id, reply_to) not in self.replies:
+                restante = prazo - time.monotonic()
+                if restante <= 0:
+                    return None
+                self._cond.wait(restante)
+            return self.replies[(chat_id, reply_to)]
+
+
+class _TelegramHandler(_QuietHandler):
+    def do_POST(self):
+        server = self.server
+        url = urlparse(self.path)
+        metodo = url.path.rsplit('/', 1)[-1]
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        corpo = self._body()
+        if corpo and self.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+            params.update({k: v[-1] for k, v in parse_qs(corpo.decode('utf-8')).items()})
+        server.wait_latency()
+
+        chat_id = int(params.get('chat_id') or 0)
+        reply_to = params.get('reply_to_message_id')
+        if params.get('reply_parameters'):
+            reply_to = json.loads(params['reply_parameters']).get('message_id')
+        message_id = server.record_reply(chat_id, int(reply_to) if reply_to else None, params.get('text', ''))
+
+        if metodo in ('sendMessage', 'editMessageText', 'sendDocument'):
+            result = {
+                'message_id': int(params.get('message_id') or message_id),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'text': params.get('text', ''),
+            }
+        else:
+            result = True
+        self._send_json({'ok': True, 'result': result})
+
+    do_GET = do_POST
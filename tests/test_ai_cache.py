@@ -0,0 +1,36 @@
+import os
+
+os.environ.setdefault('TELEGRAM_TOKEN', '123456:test')
+os.environ.setdefault('GROQ_API_KEY', 'test')
+
+import app  # noqa: E402
+
+
+def _roundtrip(texto_cache, data, texto_busca):
+    _, numeros = app._ai_cache_key(texto_cache)
+    modelo = app._ai_cache_template(data, numeros)
+    if modelo is None:
+        return None
+    _, numeros_busca = app._ai_cache_key(texto_busca)
+    return app._ai_cache_fill(modelo, numeros_busca)
+
+
+def test_template_reuses_numbers_by_position():
+    data = {'action': 'add_expense', 'amount': 50.0, 'category': 'MERCADO', 'bank': 'NUBANK'}
+    assert _roundtrip("gastei 50 no mercado pelo nubank", data, "gastei 72 no mercado pelo nubank") == \
+        {'action': 'add_expense', 'amount': 72.0, 'category': 'MERCADO', 'bank': 'NUBANK'}
+
+
+def test_template_skips_repeated_numbers():
+    data = {'action': 'add_credit_card_purchase', 'amount': 10.0, 'installments': 10,
+            'description': 'Mercado', 'card': 'NUBANK', 'category': 'MERCADO'}
+    _, numeros = app._ai_cache_key("gastei 10 no mercado em 10x no cartao")
+    assert app._ai_cache_template(data, numeros) is None
+    assert _roundtrip("gastei 10 no mercado em 10x no cartao", data, "gastei 300 no mercado em 3x no cartao") is None
+
+
+def test_template_skips_computed_numbers():
+    data = {'action': 'add_credit_card_purchase', 'amount': 300.0, 'installments': 3,
+            'description': 'Celular', 'card': 'NUBANK', 'category': 'ELETRONICOS'}
+    _, numeros = app._ai_cache_key("comprei celular em 3x de 100 no cartao nubank")
+    assert app._ai_cache_template(data, numeros) is None